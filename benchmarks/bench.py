@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""Benchmarks for the acquisition hot path.
+
+Runs against :class:`opcng.emulator.SimulatedSPI`, no hardware
+needed. Busy-wait sleeps are disabled so timings measure library
+overhead, not device latency (the inter-byte delay of non burst
+transfers is kept). For each operation reports the time per call, the
+peak memory allocated during a call and the memory retained after each
+call, e.g. by leaks or growing caches (tracemalloc, measured in
+separate passes).
+
+Results can be saved to JSON and compared with a previous run, e.g.
+on the base commit of a branch::
+
+    python benchmarks/bench.py --save base.json
+    git checkout my-branch
+    python benchmarks/bench.py --compare base.json
+
+Exits with status 1 if ``--compare`` finds operations slower than
+``--threshold``.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opcng  # noqa: E402
+from opcng import (WaitPolicy, _OPC_CMD_READ_HISTOGRAM,  # noqa: E402
+                   _OPC_CMD_READ_FW_VERSION)
+from opcng.emulator import SimulatedSPI  # noqa: E402
+
+# no sleeps at all: measure library overhead only
+NO_WAIT_POLICY = WaitPolicy(initial=0., factor=1., max_interval=0., ready_delay=0.)
+
+# typical partial read, see _OPC.histogram
+PM_FIELDS = ['PM1', 'PM2.5', 'PM10', 'SFR', 'Temperature']
+
+DEVICES = [('N3', opcng.OPCN3), ('R1', opcng.OPCR1), ('R2', opcng.OPCR2), ('N2', opcng.OPCN2)]
+
+
+def _device(kind, cls, busy_polls=0, **kwargs):
+    spi = SimulatedSPI(kind, busy_polls=busy_polls, seed=0)
+    dev = cls(spi, wait_policy=NO_WAIT_POLICY, **kwargs)
+    dev.on()
+    return dev
+
+
+def benchmarks():
+    """List of (name, function) pairs to benchmark"""
+    benches = []
+    for kind, cls in DEVICES:
+        dev = _device(kind, cls)
+        burst = _device(kind, cls, burst=True)
+        model = dev._histogram_model
+        raw = dev._read_bytes(_OPC_CMD_READ_HISTOGRAM, model.size)
+        data = model.unpack(raw)
+
+        benches += [
+            ('{}.read_bytes'.format(kind),
+             lambda dev=dev, sz=model.size: dev._read_bytes(_OPC_CMD_READ_HISTOGRAM, sz)),
+            ('{}.read_bytes[burst]'.format(kind),
+             lambda dev=burst, sz=model.size: dev._read_bytes(_OPC_CMD_READ_HISTOGRAM, sz)),
+            ('{}.unpack'.format(kind),
+             lambda model=model, raw=raw: model.unpack(raw)),
+            ('{}.checksum'.format(kind),
+             lambda dev=dev, data=data, raw=raw: dev._checksum(data, raw)),
+            ('{}.histogram'.format(kind),
+             lambda dev=dev: dev.histogram()),
+            ('{}.histogram[burst]'.format(kind),
+             lambda dev=burst: dev.histogram()),
+            ('{}.histogram[fields]'.format(kind),
+             lambda dev=burst: dev.histogram(fields=PM_FIELDS)),
+            ('{}.pm[histogram]'.format(kind),
+             lambda dev=burst: dev.pm(from_histogram=True)),
+        ]
+
+    # handshake with a few busy polls before the device is ready
+    for polls in (0, 5):
+        dev = _device('N3', opcng.OPCN3, busy_polls=polls)
+        benches.append(('N3.send_command_and_wait[busy={}]'.format(polls),
+                        lambda dev=dev: dev._send_command_and_wait(_OPC_CMD_READ_FW_VERSION)
+                        or dev._read_payload(_OPC_CMD_READ_FW_VERSION, 2)))
+
+    # full N3 status snapshot, one call at a time vs a single transaction
+    dev = _device('N3', opcng.OPCN3, busy_polls=1, burst=True)
+    tx = dev.transaction().power_state().histogram().pm()
+    benches += [
+        ('N3.snapshot[sequential]',
+         lambda dev=dev: (dev.power_state(), dev.histogram(), dev.pm())),
+        ('N3.snapshot[transaction]', tx.run),
+    ]
+
+    return benches
+
+
+def _time(func, min_time):
+    """Best of 5 mean time per call, each round lasting about min_time"""
+    n = 1
+    while True:
+        t0 = perf_counter()
+        for i in range(n):
+            func()
+        elapsed = perf_counter() - t0
+        if elapsed >= min_time / 5:
+            break
+        n *= 2
+
+    best = elapsed
+    for r in range(4):
+        t0 = perf_counter()
+        for i in range(n):
+            func()
+        best = min(best, perf_counter() - t0)
+    return best / n
+
+
+def _allocations(func, n=200):
+    """Memory blocks and bytes still allocated after each call, e.g.
+    leaks or growing caches"""
+    func()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for i in range(n):
+            func()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = size = 0
+    for stat in after.compare_to(before, 'filename'):
+        if stat.size_diff > 0:
+            blocks += stat.count_diff
+            size += stat.size_diff
+    return max(blocks, 0) / n, max(size, 0) / n
+
+
+def _peak(func, n=50):
+    """Peak memory allocated during a call, the highest of n calls,
+    in bytes"""
+    func()
+    peak = 0
+    tracemalloc.start()
+    try:
+        for i in range(n):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            func()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(pattern=None, min_time=0.5):
+    results = {}
+    for name, func in benchmarks():
+        if pattern and pattern not in name:
+            continue
+        blocks, size = _allocations(func)
+        results[name] = {'time': _time(func, min_time),
+                         'peak': _peak(func),
+                         'retained_blocks': blocks,
+                         'retained_bytes': size}
+        print(_format(name, results[name]), flush=True)
+    return results
+
+
+def _format(name, r, old=None):
+    line = '{:40s} {:10.2f} us {:8d} B peak {:7.1f} blk {:8.1f} B retained'.format(
+        name, r['time'] * 1e6, r['peak'], r['retained_blocks'], r['retained_bytes'])
+    if old is not None:
+        line += '  {:+6.1f}%'.format(100. * (r['time'] / old['time'] - 1.))
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-k', dest='pattern', help='only run benchmarks containing PATTERN')
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='approximate seconds spent timing each benchmark')
+    parser.add_argument('--save', metavar='FILE', help='save results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=20.,
+                        help='slowdown percentage reported as regression')
+    args = parser.parse_args()
+
+    print('opcng benchmarks, commit {}, Python {}'.format(_commit(), platform.python_version()))
+    results = run(args.pattern, args.min_time)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'commit': _commit(),
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print('\nCompared with commit {}:'.format(old.get('commit')))
+        regressions = []
+        for name, r in results.items():
+            if name not in old['results']:
+                continue
+            print(_format(name, r, old['results'][name]))
+            if r['time'] > old['results'][name]['time'] * (1. + args.threshold / 100.):
+                regressions.append(name)
+        if regressions:
+            print('\nRegressions: {}'.format(', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
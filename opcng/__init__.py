@@ -1,5 +1,12 @@
+import copy
+import json
+import os
+import re
 import struct
-from time import sleep
+from bisect import bisect_left
+import threading
+from types import MappingProxyType
+from time import sleep, monotonic, time
 
 import logging
 
@@ -9,8 +16,16 @@ except ImportError:
     class USBISSError(BaseException):
         pass
 
-logging.basicConfig(level=logging.WARNING)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Libraries should not configure logging, leave it to the
+# application. Without any configuration warnings and errors still go
+# to stderr through logging.lastResort.
 logger = logging.getLogger(__name__)
+_DEBUG = logging.DEBUG
 
 
 #
@@ -214,22 +229,22 @@ _OPC_N3_WRITE_CONFIG_MODEL =    [*[['BB{}'.format(b), t] for b, t in zip(range(2
 OPC_R1_READ_CONFIG_MODEL =    [*[['BB{}'.format(b), t] for b, t in zip(range(17), ["H"] * 17)],
                                *[['BBD{}'.format(b), t] for b, t in zip(range(17), ["f"] * 17)],
                                *[['BW{}'.format(b), t] for b, t in zip(range(16), ["f"] * 16)],
-                               ['GSC'                 'f'],
-                               ['SFR'                 'f'],
+                               ['GSC',                'f'],
+                               ['SFR',                'f'],
                                ['TOF to SFR factor',  'B'],
                                ['M_A',                'f'],
                                ['M_B',                'f'],
                                ['M_C',                'f'],
                                ['PVP',                'B'],
-                               ['PowerStatus'         'B'],
+                               ['PowerStatus',        'B'],
                                ['MaxTOF',             'H'],
-                               ['LaserDAC'            'B'],
+                               ['LaserDAC',           'B'],
                                ['BinWeightingIndex',  'B']]
 
 OPC_R1_WRITE_CONFIG_MODEL =    [*[['BB{}'.format(b), t] for b, t in zip(range(17), ["H"] * 17)],
                                 *[['BBD{}'.format(b), t] for b, t in zip(range(17), ["f"] * 17)],
                                 *[['BW{}'.format(b), t] for b, t in zip(range(16), ["f"] * 16)],
-                                ['GSC'                 'f'],
+                                ['GSC',                'f'],
                                 ['M_A',                'f'],
                                 ['M_B',                'f'],
                                 ['M_C',                'f'],
@@ -238,40 +253,752 @@ OPC_R1_WRITE_CONFIG_MODEL =    [*[['BB{}'.format(b), t] for b, t in zip(range(17
                                 ['MaxTOF',             'H']]
 
 
+# CRC-16 used by N3 and R1 checksums (poly 0xA001, init 0xFFFF). See
+# e.g. Appendix E, Alphasense manual 072-0502.
+_CRC16_POLY = 0xA001
+_CRC16_INIT = 0xFFFF
+
+
+def _crc16_bitwise(raw_bytes, crc=_CRC16_INIT):
+    """Reference bit by bit CRC-16. Python translation of Alphasense C
+    code, kept to cross-check the table driven version."""
+    for b in raw_bytes:
+        crc ^= b
+        for bit in range(8):
+            if (crc & 1):
+                crc >>= 1
+                crc ^= _CRC16_POLY
+            else:
+                crc >>= 1
+    return crc
+
+
+_CRC16_TABLE = tuple(_crc16_bitwise([i], 0) for i in range(256))
+
+
+def _crc16(raw_bytes, crc=_CRC16_INIT):
+    """Table driven CRC-16, one lookup per byte."""
+    table = _CRC16_TABLE
+    for b in raw_bytes:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
+
+
+def _crc16_frames(frames, size):
+    """Compute the CRC-16 of many frames at once.
+
+    The last two bytes of each frame (the checksum itself) are not
+    included. Uses numpy if available, processing one byte column of
+    all the frames at each step.
+
+    :param frames: a list of frames or a single buffer of concatenated
+                   frames, each ``size`` bytes long
+    :param size: frame size in bytes
+    :returns: a list of (computed crc, stored checksum) tuples
+    """
+    if not isinstance(frames, (bytes, bytearray, memoryview)):
+        frames = b''.join(frames)
+    if len(frames) % size:
+        raise ValueError('Buffer size {} is not a multiple of frame size {}'.format(len(frames), size))
+
+    if np is None:
+        return [(_crc16(frames[i:i + size - 2]),
+                 frames[i + size - 2] | frames[i + size - 1] << 8)
+                for i in range(0, len(frames), size)]
+
+    table = np.array(_CRC16_TABLE, dtype=np.uint16)
+    a = np.frombuffer(frames, dtype=np.uint8).reshape(-1, size)
+    crc = np.full(len(a), _CRC16_INIT, dtype=np.uint16)
+    for col in a[:, :-2].T:
+        crc = (crc >> 8) ^ table[(crc ^ col) & 0xFF]
+    stored = a[:, -2].astype(np.uint16) | (a[:, -1].astype(np.uint16) << 8)
+    return list(zip(crc.tolist(), stored.tolist()))
+
+
+# struct format characters to numpy little endian type strings
+_NUMPY_TYPES = {'B': 'u1', 'b': 'i1',
+                'H': '<u2', 'h': '<i2',
+                'I': '<u4', 'i': '<i4',
+                'L': '<u4', 'l': '<i4',
+                'Q': '<u8', 'q': '<i8',
+                'f': '<f4', 'd': '<f8'}
+
+
+def _field_identifier(field):
+    """Turn a model field name into a valid python identifier,
+    e.g. 'PM2.5' -> 'PM2_5', '#RejectGlitch' -> 'RejectGlitch'"""
+    return re.sub(r'\W+', '_', field).strip('_')
+
+
+class _record(object):
+    """Base class for __slots__ records generated from data models."""
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, *values):
+        for attr, value in zip(self.__slots__, values):
+            setattr(self, attr, value)
+
+    def __iter__(self):
+        return (getattr(self, attr) for attr in self.__slots__)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(a, v) for a, v in zip(self.__slots__, self)))
+
+    def as_dict(self):
+        """Return record values as a dictionary keyed by model field names"""
+        return dict(zip(self._fields, self))
+
+
 class _data_model(object):
     """Helper class to manage a data sequence to be read or written
     sequentially to the OPC using SPI. Mostly caches struct size,
-    fields and complete format string.
+    fields and a compiled struct.
+
+    Models are built once in :data:`_MODEL_REGISTRY` and shared by all
+    device instances: don't modify them.
+
+    Besides dictionaries, raw data can be decoded to tuples, to
+    __slots__ records (see :attr:`record_class`) or, if numpy is
+    available, straight into a preallocated structured array (see
+    :attr:`dtype` and :meth:`unpack_into`).
     """
-    def __init__(self, model):
-        self.model = model
-        self.fields = [field for field, fmt in self.model]
+    def __init__(self, model, name='record'):
+        self.model = tuple(tuple(f) for f in model)
+        self.name = name
+        self.fields = tuple(field for field, fmt in self.model)
         self.fmt = '<' + ''.join([fmt for field, fmt in self.model])
-        self.size = struct.calcsize(self.fmt)
+        self.struct = struct.Struct(self.fmt)
+        self.size = self.struct.size
+        # field name -> position in fields, for constant time lookups
+        self.index = MappingProxyType({f: i for i, f in enumerate(self.fields)})
+        self.has_checksum = 'Checksum' in self.index
+        # column groups, computed once instead of scanning field names
+        # on every conversion
+        self.bin_fields = tuple(f for f in self.fields if 'Bin ' in f)
+        self.mtof_fields = tuple(f for f in self.fields if 'MToF' in f)
+        self.pm_fields = tuple(f for f in self.fields if f in ('PM1', 'PM2.5', 'PM10'))
+        self.env_fields = tuple(f for f in self.fields if f in
+                                ('Temperature', 'Relative humidity', 'SFR', 'Sampling Period'))
+        # field offsets and formats in the raw data, for partial decoding
+        offsets = {}
+        offset = 0
+        for field, fmt in self.model:
+            offsets[field] = offset
+            offset += struct.calcsize('<' + fmt)
+        self.offsets = MappingProxyType(offsets)
+        self.formats = MappingProxyType(dict(self.model))
+        # compiled partial decoders, see projection()
+        self._projections = {}
+        self._record_class = None
+        self._dtype = None
 
     def pack(self, values):
-        raw_bytes = struct.pack(self.fmt, *values)
+        raw_bytes = self.struct.pack(*values)
         return raw_bytes
 
     def unpack(self, raw_bytes):
-        assert(len(raw_bytes) == self.size)
-
-        values = struct.unpack_from(self.fmt, raw_bytes)
+        # Struct.unpack raises struct.error on size mismatch
+        values = self.struct.unpack(raw_bytes)
 
         return dict(zip(self.fields, values))
 
+    def unpack_tuple(self, raw_bytes, offset=0):
+        """Decode raw data to a tuple ordered as model fields.
+
+        :param raw_bytes: buffer to decode
+        :param offset: where the frame starts in the buffer
+        """
+        return self.struct.unpack_from(raw_bytes, offset)
+
+    def projection(self, fields):
+        """Compile a partial decoder for some fields.
+
+        :param fields: field names, in any order
+
+        :returns: a (fields, struct) pair: requested fields in layout
+                  order and a struct.Struct decoding only them, skipping
+                  the others with pad bytes
+        """
+        key = tuple(fields)
+        p = self._projections.get(key)
+        if p is None:
+            unknown = [f for f in fields if f not in self.index]
+            if unknown:
+                raise ValueError('Unknown fields for {}: {}'.format(self.name, unknown))
+            names = sorted(set(fields), key=self.offsets.__getitem__)
+            fmt = '<'
+            pos = 0
+            for f in names:
+                if self.offsets[f] > pos:
+                    fmt += '{}x'.format(self.offsets[f] - pos)
+                fmt += self.formats[f]
+                pos = self.offsets[f] + struct.calcsize('<' + self.formats[f])
+            p = self._projections[key] = (names, struct.Struct(fmt))
+        return p
+
+    def unpack_fields(self, raw_bytes, fields, offset=0):
+        """Decode only some fields to a dictionary, see :meth:`projection`.
+
+        :param raw_bytes: buffer to decode
+        :param fields: field names
+        :param offset: where the frame starts in the buffer
+        """
+        names, decoder = self.projection(fields)
+        return dict(zip(names, decoder.unpack_from(raw_bytes, offset)))
+
+    @property
+    def record_class(self):
+        """A __slots__ record class with one attribute per model field
+        (field names converted to identifiers, see
+        :func:`_field_identifier`)"""
+        if self._record_class is None:
+            self._record_class = type(self.name, (_record,),
+                                      {'__slots__': tuple(_field_identifier(f) for f in self.fields),
+                                       '_fields': tuple(self.fields)})
+        return self._record_class
+
+    def unpack_record(self, raw_bytes, offset=0):
+        """Decode raw data to a :attr:`record_class` instance."""
+        return self.record_class(*self.struct.unpack_from(raw_bytes, offset))
+
+    @property
+    def dtype(self):
+        """A numpy structured dtype with the same memory layout as the
+        raw data. Requires numpy."""
+        if np is None:
+            raise ImportError('numpy is required for structured array support')
+        if self._dtype is None:
+            self._dtype = np.dtype([(field, _NUMPY_TYPES[fmt]) for field, fmt in self.model])
+            assert(self._dtype.itemsize == self.size)
+        return self._dtype
+
+    def empty(self, n):
+        """Allocate a zeroed structured array of n records. Requires numpy."""
+        return np.zeros(n, dtype=self.dtype)
+
+    def unpack_array(self, raw_bytes):
+        """Decode a buffer of concatenated frames to a structured array
+        without copying. Requires numpy."""
+        return np.frombuffer(raw_bytes, dtype=self.dtype)
+
+    def unpack_into(self, array, index, raw_bytes):
+        """Decode a raw frame into a preallocated structured array.
+
+        Since the array shares the raw data layout this is a plain
+        memory copy, no python objects are created for the fields.
+
+        :param array: a structured array as returned by :meth:`empty`
+        :param index: record index in the array
+        :param raw_bytes: raw frame
+        """
+        array[index:index + 1].view(np.uint8)[:] = np.frombuffer(raw_bytes, dtype=np.uint8)
+
+
+# Data models by name, built once and shared by all device instances.
+# Names are stable, recordings refer to them (see opcng.record).
+_MODEL_REGISTRY = MappingProxyType({name: _data_model(model, name) for name, model in [
+    ('OPCN3Histogram',    _OPC_N3_HISTOGRAM_MODEL),
+    ('OPCN3PM',           _OPC_N3_PM_MODEL),
+    ('OPCN3PowerState',   _OPC_N3_POPT_MODEL),
+    ('OPCN3Config',       _OPC_N3_READ_CONFIG_MODEL),
+    ('OPCN3WriteConfig',  _OPC_N3_WRITE_CONFIG_MODEL),
+    ('OPCR1Histogram',    _OPC_R1_HISTOGRAM_MODEL),
+    ('OPCR1PM',           _OPC_R1_PM_MODEL),
+    ('OPCR1Config',       OPC_R1_READ_CONFIG_MODEL),
+    ('OPCR1WriteConfig',  OPC_R1_WRITE_CONFIG_MODEL),
+    ('OPCN2Histogram',    _OPC_N2_HISTOGRAM_MODEL),
+    ('OPCN2PM',           _OPC_N2_PM_MODEL),
+    ('OPCN2PowerState',   _OPC_N2_POPT_MODEL)]})
+
+
+class RingBuffer(object):
+    """Fixed capacity, thread safe FIFO of timestamped raw frames.
+
+    Frames are stored in a single preallocated buffer of ``capacity``
+    frames, laid out as ``model``. When the buffer is full new frames
+    either replace the oldest ones (``policy='drop_oldest'``, the
+    default) or are discarded (``policy='drop_newest'``). The number of
+    discarded frames is kept in :attr:`dropped`.
+
+    :param model: data model of the frames
+    :param capacity: maximum number of frames
+    :param policy: 'drop_oldest' or 'drop_newest'
+    """
+    def __init__(self, model, capacity, policy='drop_oldest'):
+        if policy not in ('drop_oldest', 'drop_newest'):
+            raise ValueError('Invalid ring buffer policy: {}'.format(policy))
+        self.model = model
+        self.capacity = capacity
+        self.policy = policy
+        self.frames = bytearray(capacity * model.size)
+        self.timestamps = [0.] * capacity
+        self.dropped = 0
+        self.closed = False
+        self._head = 0
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self._count
+
+    def put(self, timestamp, raw_bytes):
+        """Append a frame. Returns False if the frame was discarded."""
+        with self._cond:
+            if self._count == self.capacity:
+                self.dropped += 1
+                if self.policy == 'drop_newest':
+                    return False
+                self._head = (self._head + 1) % self.capacity
+                self._count -= 1
+
+            i = (self._head + self._count) % self.capacity
+            sz = self.model.size
+            self.frames[i * sz:(i + 1) * sz] = raw_bytes
+            self.timestamps[i] = timestamp
+            self._count += 1
+            self._cond.notify()
+        return True
+
+    def get(self, timeout=None):
+        """Pop the oldest frame, waiting if the buffer is empty.
+
+        :returns: a (timestamp, raw_bytes) tuple, None on timeout or if
+                  the buffer is closed and empty
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._count or self.closed, timeout):
+                return None
+            if not self._count:
+                return None
+            i = self._head
+            sz = self.model.size
+            frame = bytes(self.frames[i * sz:(i + 1) * sz])
+            self._head = (i + 1) % self.capacity
+            self._count -= 1
+            return self.timestamps[i], frame
+
+    def close(self):
+        """Wake up readers, :meth:`get` returns None once empty."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class WaitPolicy(object):
+    """Busy-wait policy used after sending a command, see
+    :meth:`_OPC._send_command_and_wait`.
+
+    The default values reproduce the timing suggested by Alphasense
+    docs: poll every 20 ms and, after 20 attempts, leave the device
+    alone for 5 s for its SPI buffer to reset (see
+    :class:`RecoveryPolicy`).
+
+    :param initial: first poll interval in seconds
+    :param factor: poll interval multiplier after each attempt
+    :param max_interval: maximum poll interval in seconds
+    :param ready_delay: seconds to wait once the device is ready,
+                        before transferring data (default: same as
+                        the current poll interval)
+    :param deadline: give up after this many seconds, without waiting
+                     for a reset (default: no deadline, only
+                     ``reset_after``)
+    :param reset_after: attempts before giving up and waiting for the
+                        SPI buffer to reset
+    :param settle: seconds the device is left alone for the SPI buffer
+                   to reset or the device to settle after an
+                   unexpected response
+    """
+    def __init__(self, initial=0.02, factor=1., max_interval=0.1,
+                 ready_delay=None, deadline=None, reset_after=20,
+                 settle=5.):
+        self.initial = initial
+        self.factor = factor
+        self.max_interval = max_interval
+        self.ready_delay = ready_delay
+        self.deadline = deadline
+        self.reset_after = reset_after
+        self.settle = settle
+
+    def next_interval(self, interval):
+        """Poll interval for the next attempt"""
+        return min(interval * self.factor, self.max_interval)
+
+
+# Poll fast, backing off quickly to the documented 10-100 ms range
+FAST_WAIT_POLICY = WaitPolicy(initial=0.001, factor=2., max_interval=0.05,
+                              ready_delay=10e-6, deadline=2.)
+
+
+class RecoveryPolicy(object):
+    """Error recovery policy, see the ``recovery`` parameter of :class:`_OPC`.
+
+    A failed transaction never blocks. Errors after which the device
+    must be left alone (unexpected handshake responses, USB-SPI errors,
+    SPI buffer resets) quarantine it for ``WaitPolicy.settle`` seconds:
+    until then queries return immediately without data. Other errors,
+    e.g. busy-wait timeouts, are retried. After ``failure_threshold``
+    consecutive failed transactions the device circuit breaker opens
+    and the device is skipped for ``open_interval`` seconds, doubling
+    up to ``max_open_interval`` while trial transactions keep failing.
+
+    Histogram reads are not retried on checksum failures: the device
+    clears its histogram on every read.
+
+    :param retries: retries of a failed transaction, if the device
+                    doesn't need to settle
+    :param retry_delay: seconds to wait before a retry
+    :param failure_threshold: consecutive failed transactions opening
+                              the circuit breaker
+    :param open_interval: seconds the device is skipped once the
+                          circuit opens
+    :param max_open_interval: maximum open interval in seconds
+    """
+    def __init__(self, retries=0, retry_delay=0.05, failure_threshold=5,
+                 open_interval=10., max_open_interval=300.):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.failure_threshold = failure_threshold
+        self.open_interval = open_interval
+        self.max_open_interval = max_open_interval
+
+
+class CircuitBreaker(object):
+    """Per-device failure state, see :class:`RecoveryPolicy`.
+
+    :ivar state: 'closed' (normal operation), 'open' (device skipped)
+                 or 'half-open' (next transaction is a trial)
+    :ivar failures: consecutive failed transactions
+    :ivar until: monotonic time until which the device is skipped
+    :ivar trips: number of times the circuit opened
+    """
+    def __init__(self, policy, clock=monotonic):
+        self.policy = policy
+        self.clock = clock
+        self.state = 'closed'
+        self.failures = 0
+        self.until = 0.
+        self.trips = 0
+        self._interval = policy.open_interval
+
+    def available(self):
+        """True if the device can be queried now"""
+        return self.clock() >= self.until
+
+    def allow(self):
+        """Check before a transaction, an expired open circuit becomes
+        half-open"""
+        if not self.available():
+            return False
+        if self.state == 'open':
+            self.state = 'half-open'
+        return True
+
+    def success(self):
+        """Record a successful transaction. Returns True if the device
+        recovered from previous failures."""
+        recovered = self.failures > 0
+        self.state = 'closed'
+        self.failures = 0
+        self._interval = self.policy.open_interval
+        return recovered
+
+    def failure(self, settle=0.):
+        """Record a failed transaction.
+
+        :param settle: seconds the device must be left alone
+
+        :returns: 'circuit_open', 'quarantine' or None
+        """
+        now = self.clock()
+        self.failures += 1
+        if self.state == 'half-open':
+            self._interval = min(2 * self._interval, self.policy.max_open_interval)
+        if self.state == 'half-open' or self.failures >= self.policy.failure_threshold:
+            self.state = 'open'
+            self.trips += 1
+            self.until = now + max(self._interval, settle)
+            return 'circuit_open'
+        if settle:
+            self.until = now + settle
+            return 'quarantine'
+        return None
+
+    def __repr__(self):
+        return ('CircuitBreaker(state={}, failures={}, trips={}, blocked={:.3f})'
+                .format(self.state, self.failures, self.trips, max(self.until - self.clock(), 0.)))
+
+
+class CommandStats(object):
+    """Busy-wait statistics for a single command opcode.
+
+    :ivar count: number of successful handshakes
+    :ivar failures: number of failed handshakes
+    :ivar polls: dictionary mapping number of polls to the number of
+                 handshakes that needed them
+    :ivar max_polls: maximum number of polls needed
+    :ivar wait_time: total time spent waiting (s)
+    """
+    __slots__ = ('count', 'failures', 'polls', 'max_polls', 'wait_time')
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.polls = {}
+        self.max_polls = 0
+        self.wait_time = 0.
+
+    @property
+    def mean_polls(self):
+        if not self.count:
+            return 0.
+        return sum(k * v for k, v in self.polls.items()) / self.count
+
+    @property
+    def mean_wait(self):
+        if not self.count:
+            return 0.
+        return self.wait_time / self.count
+
+    def __repr__(self):
+        return ('CommandStats(count={}, failures={}, mean_polls={:.2f}, max_polls={}, mean_wait={:.6f})'
+                .format(self.count, self.failures, self.mean_polls, self.max_polls, self.mean_wait))
+
+
+# latency histogram bucket upper bounds, seconds
+_LATENCY_BUCKETS = (1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2,
+                    0.1, 0.2, 0.5, 1., 2., 5., 10.)
+
+
+class LatencyHistogram(object):
+    """Fixed buckets latency histogram.
+
+    :param bounds: bucket upper bounds in seconds, sorted. Latencies
+                   beyond the last bound go to an overflow bucket.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self, bounds=_LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+
+    def observe(self, x):
+        """Add a latency sample, in seconds"""
+        self.counts[bisect_left(self.bounds, x)] += 1
+        self.count += 1
+        self.total += x
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def quantile(self, q):
+        """Approximate quantile, as the upper bound of its bucket"""
+        target = q * self.count
+        n = 0
+        for bound, c in zip(self.bounds + (self.max,), self.counts):
+            n += c
+            if n >= target and c:
+                return min(bound, self.max)
+        return 0.
+
+    def __repr__(self):
+        return ('LatencyHistogram(count={}, mean={:.6f}, p50={:.6f}, p99={:.6f}, max={:.6f})'
+                .format(self.count, self.mean, self.quantile(.5), self.quantile(.99), self.max))
+
+
+class Metrics(object):
+    """Transaction metrics for a device, see the ``metrics`` parameter
+    of :class:`_OPC`.
+
+    Callbacks added with :meth:`subscribe` are called as
+    ``callback(event, cmd, value)`` where event is one of
+    'transaction' (value: latency in s), 'wait' (value: number of
+    busy polls), 'checksum_failure', 'short_read', 'spi_error',
+    'device_error', 'retry', 'quarantine' (device left alone to
+    settle), 'circuit_open', 'skipped' (query skipped while the device
+    was quarantined or its circuit open), 'recovery' (first success
+    after failures) or 'burst_fallback' (burst transfers disabled, see
+    the ``burst_fallback`` parameter of :class:`_OPC`).
+
+    :ivar latency: transaction latency histograms, by command opcode
+    :ivar wait_latency: busy-wait latency histograms, by command opcode
+    :ivar polls: total busy polls, by command opcode
+    :ivar transfers: number of SPI xfer calls
+    :ivar bytes_read: payload bytes read
+    :ivar bytes_written: payload bytes written
+    :ivar events: event counters, by event name
+    """
+    def __init__(self, bounds=_LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.latency = {}
+        self.wait_latency = {}
+        self.polls = {}
+        self.transfers = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.events = {'checksum_failure': 0, 'short_read': 0, 'spi_error': 0,
+                       'device_error': 0, 'retry': 0, 'quarantine': 0,
+                       'circuit_open': 0, 'skipped': 0, 'recovery': 0,
+                       'burst_fallback': 0}
+        self.callbacks = []
+
+    def subscribe(self, callback):
+        """Add an event callback"""
+        self.callbacks.append(callback)
+
+    def _histogram(self, histograms, cmd):
+        h = histograms.get(cmd)
+        if h is None:
+            h = histograms[cmd] = LatencyHistogram(self.bounds)
+        return h
+
+    def transaction(self, cmd, elapsed, nread=0, nwritten=0):
+        """Record a complete transaction (handshake and payload)"""
+        self._histogram(self.latency, cmd).observe(elapsed)
+        self.bytes_read += nread
+        self.bytes_written += nwritten
+        for callback in self.callbacks:
+            callback('transaction', cmd, elapsed)
+
+    def wait(self, cmd, polls, elapsed):
+        """Record a busy-wait handshake"""
+        self._histogram(self.wait_latency, cmd).observe(elapsed)
+        self.polls[cmd] = self.polls.get(cmd, 0) + polls
+        for callback in self.callbacks:
+            callback('wait', cmd, polls)
+
+    def event(self, name, cmd=None, value=1):
+        """Count an event, e.g. a checksum failure"""
+        self.events[name] = self.events.get(name, 0) + value
+        for callback in self.callbacks:
+            callback(name, cmd, value)
+
+    def __repr__(self):
+        return ('Metrics(transfers={}, bytes_read={}, bytes_written={}, events={})'
+                .format(self.transfers, self.bytes_read, self.bytes_written, self.events))
+
+
+# Trace record kinds
+_TRACE_BYTE = 0
+_TRACE_BURST = 1
+
+
+class TraceWriter(object):
+    """High volume binary trace of SPI transfers.
+
+    Each transfer is appended to ``fileobj`` as a compact binary
+    record: a header with timestamp (float64), kind (uint8, 0 for
+    single byte transfers, 1 for bursts) and length (uint16), followed
+    by the bytes sent and the bytes received. Use :func:`read_trace` to
+    decode it.
+
+    :param fileobj: a binary file-like object opened for writing
+    :param clock: timestamp function (default: time.time)
+    """
+    header = struct.Struct('<dBH')
+
+    def __init__(self, fileobj, clock=time):
+        self.fileobj = fileobj
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def write(self, kind, sent, received):
+        record = self.header.pack(self.clock(), kind, len(sent)) + bytes(sent) + bytes(received)
+        with self._lock:
+            self.fileobj.write(record)
+
+
+def read_trace(fileobj):
+    """Decode a binary trace written by :class:`TraceWriter`.
+
+    :param fileobj: a binary file-like object opened for reading
+    :returns: a generator of (timestamp, kind, sent, received) tuples
+    """
+    header = TraceWriter.header
+    while True:
+        buf = fileobj.read(header.size)
+        if len(buf) < header.size:
+            return
+        timestamp, kind, n = header.unpack(buf)
+        payload = fileobj.read(2 * n)
+        if len(payload) < 2 * n:
+            return
+        yield timestamp, kind, payload[:n], payload[n:]
+
+
+# partial histogram decoding plans shared by all devices, see
+# _OPC._histogram_fields
+_histogram_plans = {}
+
 
 class _OPCError(IOError):
     pass
 
 
+class _OPCResetError(_OPCError):
+    """The device must be left alone for a while to clear its SPI buffer"""
+    pass
+
+
 class _OPC(object):
     """OPC Base class, handle common logic among different devices.
 
     :param spi: a SPI device as returned by SpiDev or USBiss
+    :param burst: if True read and write data sequences in chunks of
+                  ``burst_size`` bytes per ``xfer`` call instead of
+                  one SPI transaction per byte (default: False)
+    :param burst_size: maximum number of bytes per burst transfer
+                       (default: 32)
+    :param burst_delay: inter-byte delay in microseconds, passed to
+                        the SPI driver as ``delay_usecs``. Leave it to
+                        None for drivers that don't support it
+                        (e.g. USBiss).
+    :param burst_fallback: consecutive checksum failures of burst reads
+                           before going back to one SPI transaction
+                           per byte (default: 3, None: never)
+    :param wait_policy: busy-wait timing, a :class:`WaitPolicy`
+                        (default: Alphasense suggested timing)
+    :param metrics: a :class:`Metrics` instance to collect transaction
+                    metrics (default: None, disabled)
+    :param trace: a :class:`TraceWriter` recording every SPI transfer
+                  (default: None, disabled)
+    :param recovery: error recovery, a :class:`RecoveryPolicy`
+                     (default: no retries)
     """
-    def __init__(self, spi):
+    def __init__(self, spi, burst=False, burst_size=32, burst_delay=None,
+                 burst_fallback=3, wait_policy=None, metrics=None, trace=None,
+                 recovery=None):
         self.spi = spi
+        self.burst = burst
+        self.burst_size = burst_size
+        self.burst_delay = burst_delay
+        self.burst_fallback = burst_fallback
+        # consecutive checksum failures of burst reads
+        self._burst_failures = 0
+        self.wait_policy = wait_policy or WaitPolicy()
+        self.recovery = recovery or RecoveryPolicy()
+        self.breaker = CircuitBreaker(self.recovery)
+        # busy-wait statistics, by command opcode
+        self.wait_stats = {}
+        self.metrics = metrics
+        self.trace = trace
+        # device properties that can't change while it's powered,
+        # filled lazily by cached()
+        self.capabilities = {}
+        # last configuration read from or written to the device
+        self._config = None
+        # see opcng.record.Recorder.attach
+        self.recorder = None
 
     def _send_command(self, cmd, interval=10e-6):
         """Send a single command through the SPI bus.
@@ -279,11 +1006,41 @@ class _OPC(object):
         :param interval: seconds to sleep after sending a command (default: 10us)
         """
         r = self.spi.xfer([cmd])[0]
-        logger.debug('command: 0x{:02X}, response: 0x{:02X},  sleep: {} s'.format(cmd, r, interval))
+        if self.metrics is not None:
+            self.metrics.transfers += 1
+        if self.trace is not None:
+            self.trace.write(_TRACE_BYTE, (cmd,), (r,))
+        if logger.isEnabledFor(_DEBUG):
+            logger.debug('command: 0x%02X, response: 0x%02X,  sleep: %s s', cmd, r, interval)
         sleep(interval)
         return r
 
-    def _send_command_and_wait(self, cmd):
+    def _send_burst(self, buf):
+        """Send a sequence of bytes with as few SPI transactions as
+        possible, at most ``burst_size`` bytes each. Inter-byte timing is
+        left to the SPI driver.
+
+        :param buf: list of bytes to send
+        :returns: list of bytes returned by the device
+        """
+        r = []
+        for i in range(0, len(buf), self.burst_size):
+            chunk = list(buf[i:i + self.burst_size])
+            if self.burst_delay is None:
+                rx = self.spi.xfer(chunk)
+            else:
+                rx = self.spi.xfer(chunk, 0, self.burst_delay)
+            if self.metrics is not None:
+                self.metrics.transfers += 1
+            if self.trace is not None:
+                self.trace.write(_TRACE_BURST, chunk, rx)
+            r += rx
+        if logger.isEnabledFor(_DEBUG):
+            logger.debug('burst: %d bytes in %d transfers',
+                         len(buf), -(-len(buf) // self.burst_size))
+        return r
+
+    def _send_command_and_wait(self, cmd, policy=None):
         """OPC-N3 and R1 always return _OPC_BUSY after sending a command.  The
         device keeps returning _OPC_BUSY until it's completed the
         requested operation or ready for sending or receiving a data
@@ -292,81 +1049,246 @@ class _OPC(object):
         skipping the busy/waiting logic.
 
         Raises an exception if the device gives bogus responses or if
-        it stays busy for too much time (maximum timeout: ~25 seconds)
+        it stays busy for more than ``policy.reset_after`` polls (about
+        0.4 seconds with the default :class:`WaitPolicy`) or longer than
+        ``policy.deadline``. Number of polls and time spent waiting are
+        collected in :attr:`wait_stats`.
 
         :param cmd: command opcode (single byte)
+        :param policy: poll timing, a :class:`WaitPolicy` (default:
+                       :attr:`wait_policy`)
 
         """
+        policy = policy or self.wait_policy
         r = _OPC_BUSY
         attempts = 0
+        interval = policy.initial
+        start = monotonic()
 
         while (r != _OPC_READY):
-            # The first returned byte should always be 0x31 (busy). Subsequent returned bytes will
-            # either be 0x31 (busy) or 0xF3 (ready) depending on the status of the OPC-N3. If
-            # another byte value is received by the SPI master at this stage, an error has occurred
-            # and communication should cease for > 2s to allow the OPC-N3 to realise the error and
-            # clear its buffered data. [Alphasense 072-0502]
-            if r != _OPC_BUSY:
-                # wait for the device to settle
-                sleep(5)
-                raise _OPCError("Received unexpected response 0x{:02X} for command: 0x{:02X}".format(r, cmd))
-
-            if attempts > 20:
-                # if this cycle has happened many times, e.g. 20, wait > 2s ( < 10s) for OPC's SPI
-                # buffer to reset [Alphasense 072-0503]
-                logger.warning("Device not responding, waiting for 5s for the SPI buffer to reset")
-                sleep(5)
-
-            if attempts > 25:
-                # this is not described by Alphasense manuals but I've seen it happen with N3
-                raise _OPCError("Timeout after sending command: 0x{:02X}".format(cmd))
-
-            # wait > 10 ms (< 100 ms)
-            r = self._send_command(cmd, interval=0.02)
+            error = self._wait_check(cmd, r, attempts, start, policy)
+            if error:
+                raise error
+
+            r = self._send_command(cmd, interval=0)
+            delay = self._wait_interval(r, interval, policy)
+            if delay:
+                sleep(delay)
+            interval = policy.next_interval(interval)
 
             attempts = attempts + 1
 
-    def _read_bytes(self, cmd, sz):
-        """Read a sequence of bytes.
+        self._record_wait(cmd, attempts, monotonic() - start)
+
+    def _wait_check(self, cmd, r, attempts, start, policy=None):
+        """Busy-wait bookkeeping, shared with the asyncio implementation.
+
+        :param cmd: command opcode
+        :param r: last response
+        :param attempts: number of polls so far
+        :param start: monotonic time when the wait started
+        :param policy: a :class:`WaitPolicy` (default: :attr:`wait_policy`)
+
+        :returns: an exception to raise, None to keep polling
+        """
+        policy = policy or self.wait_policy
+
+        # The first returned byte should always be 0x31 (busy). Subsequent returned bytes will
+        # either be 0x31 (busy) or 0xF3 (ready) depending on the status of the OPC-N3. If
+        # another byte value is received by the SPI master at this stage, an error has occurred
+        # and communication should cease for > 2s to allow the OPC-N3 to realise the error and
+        # clear its buffered data. [Alphasense 072-0502]
+        if r != _OPC_BUSY:
+            self._record_wait(cmd, attempts, monotonic() - start, failed=True)
+            # the device is quarantined to settle, see _record_error
+            return _OPCResetError("Received unexpected response 0x{:02X} for command: 0x{:02X}".format(r, cmd))
+
+        if attempts > policy.reset_after:
+            # if this cycle has happened many times, e.g. 20, wait > 2s ( < 10s) for OPC's SPI
+            # buffer to reset [Alphasense 072-0503]
+            self._record_wait(cmd, attempts, monotonic() - start, failed=True)
+            return _OPCResetError("Device not responding to command: 0x{:02X}, waiting for the SPI buffer to reset".format(cmd))
+
+        # this is not described by Alphasense manuals but I've seen it happen with N3
+        if policy.deadline is not None and monotonic() - start > policy.deadline:
+            self._record_wait(cmd, attempts, monotonic() - start, failed=True)
+            return _OPCError("Timeout after sending command: 0x{:02X}".format(cmd))
+
+        return None
+
+    def _wait_interval(self, r, interval, policy=None):
+        """Seconds to wait after a poll returning r"""
+        policy = policy or self.wait_policy
+        if r == _OPC_READY and policy.ready_delay is not None:
+            return policy.ready_delay
+        return interval
+
+    def _record_wait(self, cmd, polls, elapsed, failed=False):
+        """Update busy-wait statistics for cmd"""
+        stats = self.wait_stats.get(cmd)
+        if stats is None:
+            stats = self.wait_stats[cmd] = CommandStats()
+        if failed:
+            stats.failures += 1
+            return
+        stats.count += 1
+        stats.polls[polls] = stats.polls.get(polls, 0) + 1
+        stats.max_polls = max(stats.max_polls, polls)
+        stats.wait_time += elapsed
+        if self.metrics is not None:
+            self.metrics.wait(cmd, polls, elapsed)
+
+    def _read_payload(self, cmd, sz):
+        """Read the data sequence following a successful handshake.
 
         :param cmd: command opcode
         :param sz: number of bytes to read
         """
+        if self.burst:
+            return self._send_burst([cmd] * sz)
+
         buf = []
-        try:
-            self._send_command_and_wait(cmd)
-            for i in range(sz):
-                buf += [self._send_command(cmd)]
+        for i in range(sz):
+            buf += [self._send_command(cmd)]
+        return buf
 
-        except _OPCError as e:
-            logger.error("Error while reading bytes from the device: {}".format(e))
-        except USBISSError as e:
-            logger.error("USB-SPI communication error: {}".format(e))
-            logger.warning("Waiting 5 seconds for the device to settle")
-            sleep(5)
+    def _write_payload(self, buf):
+        """Write the data sequence following a successful handshake.
+
+        :param buf: list of bytes to send
+        """
+        if self.burst:
+            self._send_burst(buf)
+        else:
+            for c in buf:
+                self._send_command(c)
 
+    def _check_read_size(self, cmd, buf, sz):
+        """Convert received bytes to a bytearray, logging short reads"""
         result = bytearray(buf)
         if len(result) < sz:
             logger.error('Something failed while reading byte sequence, expected size: {}, received: {}'.format(sz, len(result)))
+            if self.metrics is not None:
+                self.metrics.event('short_read', cmd)
 
         return result
 
+    def _settle_time(self, e):
+        """Seconds the device must be left alone after an error"""
+        if isinstance(e, (USBISSError, _OPCResetError)):
+            return self.wait_policy.settle
+        return 0
+
+    def _record_error(self, cmd, e):
+        """Log a transaction error. Returns seconds the device must be
+        left alone to settle."""
+        if isinstance(e, USBISSError):
+            logger.error("USB-SPI communication error: {}".format(e))
+            if self.metrics is not None:
+                self.metrics.event('spi_error', cmd)
+        else:
+            logger.error("Error while reading bytes from the device: {}".format(e))
+            if self.metrics is not None:
+                self.metrics.event('device_error', cmd)
+        return self._settle_time(e)
+
+    def _recovery_check(self, cmd):
+        """True if the device can be queried, False while it's
+        quarantined or its circuit breaker is open"""
+        if self.breaker.allow():
+            return True
+        logger.debug('Skipping command 0x{:02X}, {}'.format(cmd, self.breaker))
+        if self.metrics is not None:
+            self.metrics.event('skipped', cmd)
+        return False
+
+    def _recovery_failure(self, cmd, e, attempt):
+        """Handle a failed transaction, shared with the asyncio
+        implementation.
+
+        :returns: seconds to wait before retrying, None to give up
+        """
+        settle = self._record_error(cmd, e)
+        if not settle and attempt < self.recovery.retries:
+            if self.metrics is not None:
+                self.metrics.event('retry', cmd)
+            return self.recovery.retry_delay
+
+        event = self.breaker.failure(settle)
+        if event == 'circuit_open':
+            logger.warning('Too many failures, skipping device for {:.1f}s'.format(
+                self.breaker.until - self.breaker.clock()))
+        elif event == 'quarantine':
+            logger.warning('Leaving the device alone for {}s to settle'.format(settle))
+        if event is not None and self.metrics is not None:
+            self.metrics.event(event, cmd)
+        return None
+
+    def _recovery_success(self, cmd):
+        """Handle a successful transaction"""
+        if self.breaker.success():
+            logger.info('Device recovered')
+            if self.metrics is not None:
+                self.metrics.event('recovery', cmd)
+
+    def _read_bytes(self, cmd, sz):
+        """Read a sequence of bytes.
+
+        :param cmd: command opcode
+        :param sz: number of bytes to read
+        """
+        if not self._recovery_check(cmd):
+            return bytearray()
+
+        buf = []
+        attempt = 0
+        while True:
+            start = monotonic()
+            try:
+                self._send_command_and_wait(cmd)
+                buf = self._read_payload(cmd, sz)
+            except (_OPCError, USBISSError) as e:
+                delay = self._recovery_failure(cmd, e, attempt)
+                if delay is None:
+                    break
+                sleep(delay)
+                attempt += 1
+            else:
+                self._recovery_success(cmd)
+                if self.metrics is not None:
+                    self.metrics.transaction(cmd, monotonic() - start, nread=len(buf))
+                break
+
+        return self._check_read_size(cmd, buf, sz)
+
     def _write_bytes(self, cmd, buf):
         """Write a sequence of bytes.
 
         :param cmd: command opcode
         :param buf: list of bytes to send
+
+        :returns: True if the bytes were written
         """
-        try:
-            self._send_command_and_wait(cmd)
-            for c in buf:
-                self._send_command(c)
-        except _OPCError as e:
-            logger.error("Error while reading bytes from the device: {}".format(e))
-        except USBISSError as e:
-            logger.error("USB-SPI communication error: {}".format(e))
-            logger.warning("Waiting 5 seconds for the device to settle")
-            sleep(5)
+        if not self._recovery_check(cmd):
+            return False
+
+        attempt = 0
+        while True:
+            start = monotonic()
+            try:
+                self._send_command_and_wait(cmd)
+                self._write_payload(buf)
+            except (_OPCError, USBISSError) as e:
+                delay = self._recovery_failure(cmd, e, attempt)
+                if delay is None:
+                    return False
+                sleep(delay)
+                attempt += 1
+            else:
+                self._recovery_success(cmd)
+                if self.metrics is not None:
+                    self.metrics.transaction(cmd, monotonic() - start, nwritten=len(buf))
+                return True
 
     def _write_struct(self, cmd, model, data):
         """Write a complex data structure using provided data model
@@ -374,9 +1296,11 @@ class _OPC(object):
 
         :param cmd: command opcode
         :param data: list of values to write
+
+        :returns: True if the data was written
         """
         raw_bytes = model.pack(data)
-        self._write_bytes(cmd, raw_bytes)
+        return self._write_bytes(cmd, raw_bytes)
 
     def _read_struct(self, cmd, model):
         """Read a complex data structure (e.g. an histogram) from the
@@ -389,21 +1313,61 @@ class _OPC(object):
         :returns: dictionary filled with the struct data
         """
         raw_bytes = self._read_bytes(cmd, model.size)
+        return self._decode_struct(model, raw_bytes)
+
+    def _decode_struct(self, model, raw_bytes, fields=None):
+        """Decode and validate raw bytes read from the device.
+
+        :param model: data structure definition
+        :param raw_bytes: raw bytes as returned by :meth:`_read_bytes`
+        :param fields: only decode these fields, they must include
+                       the ones needed by the checksum (see
+                       :meth:`_checksum_fields`)
 
+        :returns: dictionary filled with the struct data, None if
+                  the data is incomplete or the checksum is invalid
+        """
         if len(raw_bytes) < model.size:
-            logger.error('Bad histogram data, size mismatch')
+            if raw_bytes:
+                # empty reads are reported (or skipped on purpose) by _read_bytes
+                logger.error('Bad histogram data, size mismatch')
             return None
 
-        data = model.unpack(raw_bytes)
+        if fields is None:
+            data = model.unpack(raw_bytes)
+        else:
+            data = model.unpack_fields(raw_bytes, fields)
 
-        if 'Checksum' in model.fields:
+        if model.has_checksum:
             crc = self._checksum(data, raw_bytes)
             if data['Checksum'] != crc:
                 logger.warning('Bad histogram data, invalid checksum')
+                if self.metrics is not None:
+                    self.metrics.event('checksum_failure')
+                if self.burst:
+                    self._burst_checksum_failure()
                 return None
+            self._burst_failures = 0
+
+        if self.recorder is not None:
+            self.recorder.append(self, model, raw_bytes)
 
         return data
 
+    def _burst_checksum_failure(self):
+        """Some firmwares can't keep up with back to back bytes: after
+        repeated failures go back to the slow but safe path. A single
+        noisy frame doesn't count."""
+        self._burst_failures += 1
+        if self.burst_fallback is None or self._burst_failures < self.burst_fallback:
+            return
+        logger.warning('Disabling burst transfers for {} after {} checksum failures'.format(
+            type(self), self._burst_failures))
+        self.burst = False
+        self._burst_failures = 0
+        if self.metrics is not None:
+            self.metrics.event('burst_fallback')
+
     def _convert_temperature(self, x):
         """Convert temperature to °C"""
         return -45. + 175. * x / (float(1 << 16) - 1.)
@@ -417,11 +1381,19 @@ class _OPC(object):
 
         Modifies histogram bins in-place.
         """
+        if 'SFR' not in hist or 'Sampling Period' not in hist:
+            # partial histogram without bins
+            return hist
         ml_per_period = hist['SFR'] * hist['Sampling Period']
-        if ml_per_period > 0:
-            for field in self._histogram_model.fields:
-                if 'Bin ' in field:
-                    hist[field] = hist[field] / ml_per_period
+        if np is not None and isinstance(ml_per_period, np.ndarray):
+            # batch of histograms, leave rows with no flow untouched
+            ml_per_period = np.where(ml_per_period > 0, ml_per_period, 1.)
+        elif not ml_per_period > 0:
+            return hist
+
+        for field in self._histogram_model.bin_fields:
+            if field in hist:
+                hist[field] = hist[field] / ml_per_period
 
         return hist
 
@@ -429,11 +1401,54 @@ class _OPC(object):
         """Convert MToF from 1/3us units.
 
         Modifies MToF bins in-place"""
-        for field in self._histogram_model.fields:
-            if 'MToF' in field:
+        for field in self._histogram_model.mtof_fields:
+            if field in hist:
                 hist[field] = hist[field] / 3.
         return hist
 
+    # commands supported by all the devices, subclasses extend this
+    _commands = frozenset([_OPC_CMD_WRITE_POWER_STATE, _OPC_CMD_READ_INFO_STRING,
+                           _OPC_CMD_READ_SERIAL_STRING, _OPC_CMD_READ_FW_VERSION,
+                           _OPC_CMD_READ_HISTOGRAM, _OPC_CMD_READ_PM,
+                           _OPC_CMD_CHECK_STATUS, _OPC_CMD_RESET])
+    # True if supported commands depend on firmware version
+    _commands_need_fwversion = False
+
+    def _commands_for(self, fwversion):
+        """Supported command opcodes for a given firmware version"""
+        return self._commands
+
+    def cached(self, name):
+        """Get a device property, querying the device only the first time.
+
+        :param name: one of 'info', 'serial', 'fwversion' or
+                     'commands' (the set of supported command opcodes)
+        """
+        if name not in self.capabilities:
+            if name == 'commands':
+                fwversion = self.cached('fwversion') if self._commands_need_fwversion else None
+                if self._commands_need_fwversion and fwversion is None:
+                    # unknown firmware, assume the oldest: don't cache it
+                    return self._commands_for(None)
+                value = self._commands_for(fwversion)
+            else:
+                value = getattr(self, name)()
+            if not value:
+                # failed query, don't cache it
+                return value
+            self.capabilities[name] = value
+        return self.capabilities[name]
+
+    def supports(self, cmd):
+        """Check if the device supports a command opcode"""
+        return cmd in self.cached('commands')
+
+    def invalidate_capabilities(self):
+        """Clear cached device properties and configuration, e.g. after
+        a reset"""
+        self.capabilities.clear()
+        self._config = None
+
     def info(self):
         """Query device information"""
         buf = self._read_bytes(_OPC_CMD_READ_INFO_STRING, 60)
@@ -445,66 +1460,297 @@ class _OPC(object):
         return buf.decode()
 
     def fwversion(self):
-        """Query device firmware version"""
-        major, minor = self._read_bytes(_OPC_CMD_READ_FW_VERSION, 2)
+        """Query device firmware version
+
+        :returns: a (major, minor) tuple, None if the query failed
+        """
+        buf = self._read_bytes(_OPC_CMD_READ_FW_VERSION, 2)
+        if len(buf) != 2:
+            return None
+        major, minor = buf
         return major, minor
 
     def ping(self):
         """Check device status. Returns True if the device is responding."""
+        if not self.breaker.allow():
+            return False
         try:
             self._send_command_and_wait(_OPC_CMD_CHECK_STATUS)
-            return True
-        except BaseException:
+        except (Exception, USBISSError) as e:
+            self._recovery_failure(_OPC_CMD_CHECK_STATUS, e, self.recovery.retries)
             return False
+        self._recovery_success(_OPC_CMD_CHECK_STATUS)
+        return True
 
     def _checksum(self, data, raw_bytes):
         """Checksum calculation for OPC-N3 and R1. See e.g. Appendix E,
-        Alphasense manual 072-0502. Python translation of their C code.
+        Alphasense manual 072-0502.
         """
         # the following only works for N3 and R1, N2 is different and
         # should override this
-        raw_bytes = raw_bytes[:-2]
-        poly = 0xA001
-        init_crc_val = 0xFFFF
-
-        crc = init_crc_val
-
-        for i in range(len(raw_bytes)):
-            crc ^= raw_bytes[i]
-            for bit in range(8):
-                if (crc & 1):
-                    crc >>= 1
-                    crc ^= poly
-                else:
-                    crc >>= 1
+        return _crc16(raw_bytes[:-2])
 
-        return crc
+    def verify_checksums(self, frames, model=None):
+        """Verify checksums of many raw frames at once, e.g. from an
+        archive of raw histograms.
 
-    def histogram(self, raw=False):
+        :param frames: a list of raw frames or a buffer of concatenated
+                       frames
+        :param model: data model of the frames (default: histogram)
+
+        :returns: a list of booleans, True where the checksum matches
+        """
+        model = model or self._histogram_model
+        return [crc == stored for crc, stored in _crc16_frames(frames, model.size)]
+
+    def histogram(self, raw=False, fields=None):
         """Query and decode histogram data.
 
         :param raw: if True do not post process data (e.g. converting
                     raw temperature to degrees etc.) and return raw
                     numbers instead.
+        :param fields: if given, only decode and post process these
+                       fields, e.g. ``['PM2.5', 'SFR', 'Temperature']``.
+                       The checksum is verified anyway.
 
         :returns: a dictionary of histogram bins and auxiliary data
         """
-        data = self._read_struct(_OPC_CMD_READ_HISTOGRAM, self._histogram_model)
-        if raw or (data is None):
+        if fields is None:
+            data = self._read_struct(_OPC_CMD_READ_HISTOGRAM, self._histogram_model)
+            return self._finish_histogram(data, raw)
+
+        decode, output = self._histogram_fields(fields, raw)
+        raw_bytes = self._read_bytes(_OPC_CMD_READ_HISTOGRAM, self._histogram_model.size)
+        data = self._decode_struct(self._histogram_model, raw_bytes, decode)
+        return self._finish_histogram(data, raw, output)
+
+    def _checksum_fields(self, model):
+        """Fields needed to verify the checksum of a model"""
+        return ['Checksum'] if model.has_checksum else []
+
+    def _histogram_fields(self, fields, raw):
+        """Plan a partial histogram decoding.
+
+        :returns: a (decode, output) pair: fields to decode, including
+                  the ones needed by the checksum and post processing,
+                  and fields to return (None if the same)
+        """
+        key = (type(self), tuple(fields), raw)
+        plan = _histogram_plans.get(key)
+        if plan is None:
+            model = self._histogram_model
+            unknown = [f for f in fields if f not in model.index]
+            if unknown:
+                raise ValueError('Unknown histogram fields: {}'.format(unknown))
+            needed = set(fields) | set(self._checksum_fields(model))
+            if not raw and set(fields) & set(model.bin_fields):
+                # counts per ml
+                needed |= {'SFR', 'Sampling Period'}
+            decode = tuple(sorted(needed, key=model.index.__getitem__))
+            output = None if needed == set(fields) else tuple(fields)
+            plan = _histogram_plans[key] = (decode, output)
+        return plan
+
+    def _finish_histogram(self, data, raw, fields=None):
+        """Post process decoded histogram data unless raw is requested,
+        keeping only some fields if given"""
+        if data is None:
             return data
+        if not raw:
+            data = self._histogram_post_process(data)
+        if fields is not None:
+            data = {f: data[f] for f in fields}
+        return data
+
+    def histogram_batch(self, frames, raw=False, check=True):
+        """Decode and post process many raw histograms at once, e.g. to
+        reprocess an archive of raw frames. Requires numpy.
+
+        Conversions are the same as :meth:`histogram` but run on whole
+        columns instead of one histogram at a time.
+
+        :param frames: a buffer of concatenated raw frames, a list of
+                       raw frames or a structured array with the
+                       histogram model dtype
+        :param raw: if True do not post process data
+        :param check: if True drop frames with invalid checksum
+
+        :returns: a structured array, one record per valid frame. Post
+                  processed fields are all converted to float64.
+        """
+        if np is None:
+            raise ImportError('numpy is required for batch processing')
+
+        model = self._histogram_model
+        if isinstance(frames, np.ndarray):
+            raw_bytes = frames.tobytes()
+        elif isinstance(frames, (bytes, bytearray, memoryview)):
+            raw_bytes = frames
         else:
-            return self._histogram_post_process(data)
+            raw_bytes = b''.join(frames)
+        data = model.unpack_array(raw_bytes)
 
-    def pm(self):
+        if check and model.has_checksum:
+            valid = np.array(self.verify_checksums(raw_bytes), dtype=bool)
+            if not valid.all():
+                logger.warning('Dropping {} histograms with invalid checksum'.format((~valid).sum()))
+            data = data[valid]
+
+        if raw:
+            return data.copy()
+
+        columns = {f: data[f].astype(np.float64) for f in model.fields}
+        columns = self._histogram_post_process(columns)
+
+        result = np.empty(len(data), dtype=[(f, np.float64) for f in model.fields])
+        for f in model.fields:
+            result[f] = columns[f]
+        return result
+
+    def _read_histogram_frame(self):
+        """Read a raw histogram, returns None if invalid"""
+        raw_bytes = self._read_bytes(_OPC_CMD_READ_HISTOGRAM, self._histogram_model.size)
+        if self._decode_struct(self._histogram_model, raw_bytes) is None:
+            return None
+        return bytes(raw_bytes)
+
+    def _stream_direct(self, period, count, stop=None):
+        next_t = monotonic()
+        n = 0
+        while count is None or n < count:
+            delay = next_t - monotonic()
+            if stop is not None:
+                if stop.wait(max(delay, 0)):
+                    break
+            elif delay > 0:
+                sleep(delay)
+            if delay < -period:
+                # the consumer fell behind: skip missed periods
+                next_t += (-delay // period) * period
+            next_t += period
+
+            timestamp = time()
+            raw_bytes = self._read_histogram_frame()
+            if raw_bytes is not None:
+                n += 1
+                yield timestamp, raw_bytes
+
+    def _stream_buffered(self, period, count, ring):
+        stop = threading.Event()
+
+        def acquire():
+            for timestamp, raw_bytes in self._stream_direct(period, count, stop):
+                ring.put(timestamp, raw_bytes)
+            ring.close()
+
+        t = threading.Thread(target=acquire, daemon=True)
+        t.start()
+        try:
+            while True:
+                item = ring.get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            stop.set()
+            ring.close()
+            t.join()
+
+    def stream(self, period=1., raw=False, count=None, buffer=None, policy='drop_oldest'):
+        """Acquire histograms periodically.
+
+        Without a buffer, histograms are read when the consumer asks for
+        the next one. Periods are kept without drift and the ones
+        missed because the consumer is too slow are skipped.
+
+        With a buffer, histograms are read in a background thread and
+        queued in a :class:`RingBuffer` of ``buffer`` frames; ``policy``
+        decides which samples are dropped when the consumer falls
+        behind.
+
+        :param period: sampling period in seconds, must be positive
+        :param raw: if True yield raw bytes instead of decoded and post
+                    processed histograms
+        :param count: stop after count samples (default: never)
+        :param buffer: ring buffer capacity, or a :class:`RingBuffer`
+                       (default: no buffer)
+        :param policy: 'drop_oldest' or 'drop_newest'
+
+        :returns: a generator of (timestamp, histogram) tuples
+        :Example:
+
+        >>> for timestamp, hist in dev.stream(period=1., buffer=600):
+        ...     print(timestamp, hist['PM2.5'])
+        """
+        if not period > 0:
+            raise ValueError('Sampling period must be positive, got {}'.format(period))
+        return self._stream(period, raw, count, buffer, policy)
+
+    def _stream(self, period, raw, count, buffer, policy):
+        if buffer is None:
+            frames = self._stream_direct(period, count)
+        else:
+            if not isinstance(buffer, RingBuffer):
+                buffer = RingBuffer(self._histogram_model, buffer, policy)
+            frames = self._stream_buffered(period, count, buffer)
+
+        try:
+            for timestamp, raw_bytes in frames:
+                if raw:
+                    yield timestamp, raw_bytes
+                else:
+                    data = self._histogram_model.unpack(raw_bytes)
+                    yield timestamp, self._histogram_post_process(data)
+        finally:
+            frames.close()
+
+    def pm(self, from_histogram=False):
         """Query particle mass loadings.
 
+        :param from_histogram: if True read PM values from a histogram
+                               instead of the READ_PM command, only
+                               decoding PM fields. To get both the
+                               histogram and PM values from a single
+                               read see :meth:`sample`.
+
         :returns: a dictionary containing PM1, PM2.5 and PM10 data.
         """
+        if from_histogram:
+            return self.histogram(fields=self._histogram_model.pm_fields)
         return self._read_struct(_OPC_CMD_READ_PM, self._pm_model)
 
-    def read_config(self):
+    def sample(self, engine=None):
+        """Read a histogram and PM values with a single histogram read,
+        e.g. once per sampling cycle instead of calling both
+        :meth:`histogram` and :meth:`pm`.
+
+        :param engine: a :class:`opcng.pm.PMEngine` recomputing PM
+                       values from the histogram bins (default: PM
+                       values computed by the device)
+
+        :returns: a (histogram, pm) pair, None if the read failed.
+                  The histogram keeps the device PM values.
+        :Example:
+
+        >>> hist, pm = dev.sample(PMEngine.from_device(dev, density=1.5))
+        """
+        return self._sample(self.histogram(), engine)
+
+    def _sample(self, hist, engine):
+        """PM values of a histogram, shared with the asyncio implementation"""
+        if hist is None:
+            return None
+        if engine is not None:
+            return hist, engine(hist)
+        return hist, {f: hist[f] for f in self._histogram_model.pm_fields}
+
+    def read_config(self, cached=False):
         """Query configuration variables.
 
+        :param cached: if True return the last configuration read from
+                       or written to the device, if any, without
+                       querying it
+
         :returns: a dictionary of configuration variables as described
         by Alphasense Supplemental SPI Information document.
 
@@ -513,9 +1759,49 @@ class _OPC(object):
             logger.warning("read_config not supported for {}".format(type(self)))
             return None
 
-        return self._read_struct(_OPC_CMD_READ_CONFIG, self._read_config_model)
+        if cached and self._config is not None:
+            return dict(self._config)
+
+        config = self._read_struct(_OPC_CMD_READ_CONFIG, self._read_config_model)
+        self._config = None if config is None else dict(config)
+        return config
+
+    def _merge_config(self, config_dict, update_dict):
+        """Merge configuration updates into current configuration.
+
+        :returns: a list of values ordered as the write config model
+        """
+        # AlphaSense doc is a bit ugly here, it seems not all
+        # variables that we can read can also be written. Hence the
+        # need for two different data models.
+        writable = self._write_config_model.index
+        config_dict = {k: v for k, v in config_dict.items() if k in writable}
+
+        invalid_keys = [k for k in update_dict if k not in writable]
+        if (len(invalid_keys) > 0):
+            logger.warning("Some config variables are not writeable and will be ignored: {}"
+                           .format(invalid_keys))
+
+        update_dict = {k: v for k, v in update_dict.items() if k in writable}
+
+        config_dict.update(update_dict)
+        # dictionary order can't be trusted, force values to the same
+        # order as data model
+        values = [config_dict[k] for k in self._write_config_model.fields]
+        return values
+
+    def _config_changed(self, config_dict, values):
+        """Check if values differ from current configuration. Compare
+        encoded data so float values are matched at device precision."""
+        model = self._write_config_model
+        current = [config_dict[k] for k in model.fields]
+        return model.pack(current) != model.pack(values)
+
+    def _store_config(self, values):
+        """Update cached configuration after a write"""
+        self._config.update(zip(self._write_config_model.fields, values))
 
-    def update_config(self, update_dict):
+    def update_config(self, update_dict, force=False):
         """Update configuration variables.
 
         Reads current configuration variables and update selected
@@ -523,7 +1809,14 @@ class _OPC(object):
         memory so a power cycle will rset configuration to previously
         stored state.
 
+        Current configuration is only read from the device the first
+        time, then a cached copy is used (call :meth:`read_config` to
+        refresh it). Nothing is written if the device configuration
+        already matches the requested values.
+
         :param update_dict: a dictionary of configuration values to update
+        :param force: write configuration even if unchanged
+        :returns: True if the configuration was written
         :Example:
 
         # remap PM2.5 to PM4.5 on OPCN3
@@ -533,30 +1826,25 @@ class _OPC(object):
         """
         if not hasattr(self, '_write_config_model'):
             logger.warning("update_config not supported for {}".format(type(self)))
-            return
-
-        config_dict = self.read_config()
-
-        # AlphaSense doc is a bit ugly here, it seems not all
-        # variables that we can read can also be written. Hence the
-        # need for two different data models.
-        config_dict = {k: v for k, v in config_dict.items()
-                       if k in self._write_config_model.fields}
+            return False
 
-        invalid_keys = set(update_dict.keys()) - set(self._write_config_model.fields)
-        if (len(invalid_keys) > 0):
-            logger.warning("Some config variables are not writeable and will be ignored: {}"
-                           .format(list(invalid_keys)))
+        config_dict = self.read_config(cached=True)
+        if config_dict is None:
+            logger.error("Could not read current configuration")
+            return False
 
-        update_dict = {k: v for k, v in update_dict.items()
-                       if k in self._write_config_model.fields}
+        values = self._merge_config(config_dict, update_dict)
+        if not force and not self._config_changed(config_dict, values):
+            logger.info("Configuration unchanged, skipping write")
+            return False
 
-        config_dict.update(update_dict)
-        # dictionary order can't be trusted, force values to the same
-        # order as data model
-        values = [config_dict[k] for k in self._write_config_model.fields]
-        self._write_struct(_OPC_CMD_WRITE_CONFIG,
-                           self._write_config_model, values)
+        if not self._write_struct(_OPC_CMD_WRITE_CONFIG,
+                                  self._write_config_model, values):
+            # the device state is unknown, read it again next time
+            logger.error("Could not write configuration")
+            self._config = None
+            return False
+        self._store_config(values)
 
         # it seems the device goes unresponsive for a while and
         # returns bogus data right after writing configuration
@@ -565,23 +1853,305 @@ class _OPC(object):
         # documented by Alphasense
         sleep(1)
         while not self.ping():
+            if self.metrics is not None:
+                self.metrics.event('retry', _OPC_CMD_CHECK_STATUS)
             sleep(1)
 
+        return True
+
+    def transaction(self, ready_delay=0.):
+        """Start a batch of reads run back to back, see :class:`Transaction`.
+
+        :param ready_delay: seconds to wait once the device is ready,
+                            overriding :attr:`wait_policy`
+
+        :returns: a :class:`Transaction`
+        :Example:
+
+        >>> tx = dev.transaction()
+        >>> tx.power_state().histogram().pm()
+        >>> r = tx.run()
+        >>> r['histogram']['PM2.5'], r.bus_time
+        """
+        return Transaction(self, ready_delay)
+
+
+class TransactionResult(dict):
+    """Results of a :class:`Transaction`, keyed by read name. Reads
+    not completed are None.
+
+    :ivar bus_time: seconds spent on the bus, from the first command
+                    to the end of the last data transfer
+    :ivar error: the exception aborting the batch, or None
+    :ivar skipped: True if the batch didn't run because the device is
+                   quarantined or its circuit breaker is open (error
+                   is set too)
+    """
+    def __init__(self, names):
+        super().__init__((name, None) for name in names)
+        self.bus_time = 0.
+        self.error = None
+        self.skipped = False
+
+
+class Transaction(object):
+    """A batch of reads run back to back on a device.
+
+    Reads are queued by name (see the methods below, chainable), then
+    :meth:`run` performs all the handshakes and data transfers in a
+    row, with no sleeps between them and none once the device is ready,
+    and only then decodes and post processes the data. PM values read
+    from histograms (see :meth:`pm`) come from the frame of the queued
+    histogram read, if any, instead of a second read. There are no
+    retries: the first failure aborts the batch, see
+    :class:`TransactionResult`.
+
+    :param dev: an OPC
+    :param ready_delay: seconds to wait once the device is ready
+    """
+    def __init__(self, dev, ready_delay=0.):
+        self.dev = dev
+        self.policy = copy.copy(dev.wait_policy)
+        self.policy.ready_delay = ready_delay
+        # (name, method, kwargs)
+        self._reads = []
+        # bus operations by READ_PM support, see _plan()
+        self._plans = {}
+
+    def _add(self, name, method, **kwargs):
+        if any(name == n for n, m, k in self._reads):
+            raise ValueError('{} already queued'.format(name))
+        self._reads.append((name, method, kwargs))
+        self._plans.clear()
+        return self
+
+    def _model(self, attr, name):
+        model = getattr(self.dev, attr, None)
+        if model is None:
+            raise ValueError('{} not supported for {}'.format(name, type(self.dev).__name__))
+        return model
+
+    def histogram(self, raw=False, fields=None, name='histogram'):
+        """Queue a histogram read, see :meth:`_OPC.histogram`"""
+        return self._add(name, 'histogram', raw=raw, fields=fields)
+
+    def pm(self, from_histogram=False, name='pm'):
+        """Queue a PM read, see :meth:`_OPC.pm`"""
+        return self._add(name, 'pm', from_histogram=from_histogram)
+
+    def power_state(self, name='power_state'):
+        """Queue a power state read"""
+        self._model('_popt_model', 'power_state')
+        return self._add(name, 'power_state')
+
+    def read_config(self, name='read_config'):
+        """Queue a configuration read, see :meth:`_OPC.read_config`"""
+        self._model('_read_config_model', 'read_config')
+        return self._add(name, 'read_config')
+
+    def info(self, name='info'):
+        """Queue an information string read"""
+        return self._add(name, 'info')
+
+    def serial(self, name='serial'):
+        """Queue a serial string read"""
+        return self._add(name, 'serial')
+
+    def fwversion(self, name='fwversion'):
+        """Queue a firmware version read"""
+        return self._add(name, 'fwversion')
+
+    def ping(self, name='ping'):
+        """Queue a status check, True if completed"""
+        return self._add(name, 'ping')
+
+    def _needs_pm_check(self):
+        return any(m == 'pm' and not k['from_histogram'] for n, m, k in self._reads)
+
+    def _plan(self, read_pm=True):
+        """Bus operations and outputs, see :meth:`_build_plan`.
+
+        :param read_pm: False if the device doesn't support READ_PM
+        """
+        plan = self._plans.get(read_pm)
+        if plan is None:
+            plan = self._plans[read_pm] = self._build_plan(read_pm)
+        return plan
+
+    def _build_plan(self, read_pm):
+        """Plan the bus operations.
+
+        PM values read from histograms share the frame of a queued
+        histogram read, if any: the device clears its histogram on
+        each read, a second read would cover an almost empty sampling
+        period.
+
+        Each frame is decoded and validated once, also when shared.
+
+        :returns: an (ops, outputs) pair: ops a list of (cmd, size,
+                  decode) bus operations, decode validating and
+                  decoding the raw bytes read, outputs a list of (name,
+                  op index, finish) tuples, finish turning the decoded
+                  data of the op into the output (None to use it as is)
+        """
+        dev = self.dev
+        model = dev._histogram_model
+        ops = []
+        outputs = []
+        # (histogram op index, fields to decode) for each histogram output
+        histogram_decodes = []
+        # frame shared with PM reads: the first histogram read
+        histogram_op = None
+        shared = any(m == 'histogram' for n, m, k in self._reads)
+        for name, method, kwargs in self._reads:
+            if method == 'pm' and (kwargs['from_histogram'] or not read_pm):
+                method, kwargs = 'histogram', {'raw': False,
+                                               'fields': model.pm_fields,
+                                               'share': True}
+
+            if method == 'histogram':
+                raw, fields = kwargs['raw'], kwargs['fields']
+                decode, output = (None, None) if fields is None else dev._histogram_fields(fields, raw)
+                if kwargs.get('share') and shared:
+                    # resolved below, once the first histogram read is planned
+                    op = None
+                else:
+                    op = len(ops)
+                    if histogram_op is None:
+                        histogram_op = op
+                    ops.append((_OPC_CMD_READ_HISTOGRAM, model.size))
+                    shared = True
+                outputs.append((name, op, self._histogram_finish(raw, decode, output)))
+                histogram_decodes.append((op, decode))
+                continue
+
+            if method in ('pm', 'power_state', 'read_config'):
+                cmd, attr = {'pm': (_OPC_CMD_READ_PM, '_pm_model'),
+                             'power_state': (_OPC_CMD_READ_POWER_STATE, '_popt_model'),
+                             'read_config': (_OPC_CMD_READ_CONFIG, '_read_config_model')}[method]
+                struct_model = getattr(dev, attr)
+
+                def decode(b, struct_model=struct_model, method=method):
+                    data = dev._decode_struct(struct_model, b)
+                    if method == 'read_config' and data is not None:
+                        dev._config = dict(data)
+                    return data
+                size = struct_model.size
+            elif method in ('info', 'serial'):
+                cmd = _OPC_CMD_READ_INFO_STRING if method == 'info' else _OPC_CMD_READ_SERIAL_STRING
+                size = 60
+
+                def decode(b):
+                    return b.decode()
+            elif method == 'fwversion':
+                cmd, size = _OPC_CMD_READ_FW_VERSION, 2
+
+                def decode(b):
+                    return tuple(b) if len(b) == 2 else None
+            else:
+                cmd, size = _OPC_CMD_CHECK_STATUS, 0
+
+                def decode(b):
+                    return True
+            outputs.append((name, len(ops), None))
+            ops.append((cmd, size, decode))
+
+        # decode each histogram frame once, with the fields of all its outputs
+        histogram_fields = {}
+        for op, decode in histogram_decodes:
+            op = histogram_op if op is None else op
+            if decode is None or histogram_fields.get(op, ()) is None:
+                histogram_fields[op] = None
+            else:
+                histogram_fields[op] = histogram_fields.get(op, set()) | set(decode)
+        for op, fields in histogram_fields.items():
+            if fields is not None:
+                fields = tuple(sorted(fields, key=model.index.__getitem__))
+
+            def decode(b, fields=fields):
+                return dev._decode_struct(model, b, fields)
+            ops[op] = ops[op] + (decode,)
+
+        outputs = [(name, histogram_op if op is None else op, finish)
+                   for name, op, finish in outputs]
+        return ops, outputs
+
+    def _histogram_finish(self, raw, decode, output):
+        """Post process a decoded histogram frame, see
+        :meth:`_OPC._histogram_fields`"""
+        dev = self.dev
+
+        def finish(data):
+            if data is None:
+                return None
+            # post processing is in-place and the frame may be shared
+            data = dict(data) if decode is None else {f: data[f] for f in decode}
+            return dev._finish_histogram(data, raw, output)
+        return finish
+
+    def _execute(self, plan):
+        """Run planned bus operations, blocking. Shared with the asyncio
+        implementation, which runs it in an executor."""
+        dev = self.dev
+        ops, outputs = plan
+        result = TransactionResult(name for name, op, finish in outputs)
+        if not ops:
+            return result
+        if not dev._recovery_check(ops[0][0]):
+            result.skipped = True
+            result.error = _OPCError('Device quarantined or circuit open, transaction skipped')
+            return result
+
+        raws = []
+        start = monotonic()
+        try:
+            for cmd, size, decode in ops:
+                t = monotonic()
+                # blocking implementation, also on asyncio devices
+                _OPC._send_command_and_wait(dev, cmd, self.policy)
+                buf = dev._read_payload(cmd, size) if size else []
+                raws.append(buf)
+                if dev.metrics is not None:
+                    dev.metrics.transaction(cmd, monotonic() - t, nread=len(buf))
+        except (_OPCError, USBISSError) as e:
+            # no retries, they would sleep within the batch
+            dev._recovery_failure(cmd, e, dev.recovery.retries)
+            result.error = e
+        else:
+            dev._recovery_success(cmd)
+        result.bus_time = monotonic() - start
+
+        decoded = [decode(dev._check_read_size(cmd, raw, size))
+                   for (cmd, size, decode), raw in zip(ops, raws)]
+        for name, op, finish in outputs:
+            if op < len(decoded):
+                result[name] = decoded[op] if finish is None else finish(decoded[op])
+        return result
+
+    def run(self):
+        """Run the queued reads. Transactions can be run many times,
+        e.g. once per sampling period.
+
+        :returns: a :class:`TransactionResult`
+        """
+        read_pm = self.dev.supports(_OPC_CMD_READ_PM) if self._needs_pm_check() else True
+        return self._execute(self._plan(read_pm))
 
 
 class OPCN3(_OPC):
     """OPC-N3
 
     :param spi: a SPI device as returned by SpiDev or USBiss
+    :param kwargs: transfer options, see :class:`_OPC`
     """
-    def __init__(self, spi):
-        super().__init__(spi)
+    _commands = _OPC._commands | {_OPC_CMD_READ_POWER_STATE,
+                                  _OPC_CMD_READ_CONFIG, _OPC_CMD_WRITE_CONFIG}
 
-        self._histogram_model = _data_model(_OPC_N3_HISTOGRAM_MODEL)
-        self._popt_model = _data_model(_OPC_N3_POPT_MODEL)
-        self._pm_model = _data_model(_OPC_N3_PM_MODEL)
-        self._read_config_model = _data_model(_OPC_N3_READ_CONFIG_MODEL)
-        self._write_config_model = _data_model(_OPC_N3_WRITE_CONFIG_MODEL)
+    _histogram_model = _MODEL_REGISTRY['OPCN3Histogram']
+    _popt_model = _MODEL_REGISTRY['OPCN3PowerState']
+    _pm_model = _MODEL_REGISTRY['OPCN3PM']
+    _read_config_model = _MODEL_REGISTRY['OPCN3Config']
+    _write_config_model = _MODEL_REGISTRY['OPCN3WriteConfig']
 
     def power_state(self):
         """Report peripherals and digital pots state.
@@ -605,7 +2175,7 @@ class OPCN3(_OPC):
     # for on.
     def fan_off(self):
         """Power off fan."""
-        self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [_OPC_N3_POPT_FAN_POT << 1 | 0])
+        return self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [_OPC_N3_POPT_FAN_POT << 1 | 0])
 
     def fan_on(self):
         """Power on fan.
@@ -614,15 +2184,15 @@ class OPCN3(_OPC):
         absorption peak to pass before sending more commands.
 
         """
-        self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [_OPC_N3_POPT_FAN_POT << 1 | 1])
+        return self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [_OPC_N3_POPT_FAN_POT << 1 | 1])
 
     def laser_off(self):
         """Power off laser."""
-        self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [_OPC_N3_POPT_LASER_SWITCH << 1 | 0])
+        return self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [_OPC_N3_POPT_LASER_SWITCH << 1 | 0])
 
     def laser_on(self):
         """Power on laser."""
-        self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [_OPC_N3_POPT_LASER_SWITCH << 1 | 1])
+        return self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [_OPC_N3_POPT_LASER_SWITCH << 1 | 1])
 
     def on(self):
         """Power on peripherals (both laser and fan).
@@ -646,15 +2216,21 @@ class OPCN3(_OPC):
         manufacturer docs.
 
         """
-        self._send_command_and_wait(_OPC_CMD_RESET)
+        self.invalidate_capabilities()
+        return self._send_command_and_wait(_OPC_CMD_RESET)
 
     def _histogram_post_process(self, hist):
-        """Convert histogram raw data into proper measurements."""
-        hist['Temperature'] = self._convert_temperature(hist['Temperature'])
-        hist['Relative humidity'] = self._convert_humidity(hist['Relative humidity'])
-
-        hist['Sampling Period'] = hist['Sampling Period'] / 100.
-        hist['SFR'] = hist['SFR'] / 100.
+        """Convert histogram raw data into proper measurements. Fields
+        missing from partial histograms are skipped."""
+        if 'Temperature' in hist:
+            hist['Temperature'] = self._convert_temperature(hist['Temperature'])
+        if 'Relative humidity' in hist:
+            hist['Relative humidity'] = self._convert_humidity(hist['Relative humidity'])
+
+        if 'Sampling Period' in hist:
+            hist['Sampling Period'] = hist['Sampling Period'] / 100.
+        if 'SFR' in hist:
+            hist['SFR'] = hist['SFR'] / 100.
 
         hist = self._convert_hist_to_count_per_ml(hist)
         hist = self._convert_mtof(hist)
@@ -667,12 +2243,10 @@ class OPCR1(_OPC):
     """OPC-R1
 
     :param spi: a SPI device as returned by SpiDev or USBiss
+    :param kwargs: transfer options, see :class:`_OPC`
     """
-    def __init__(self, spi):
-        super().__init__(spi)
-
-        self._histogram_model = _data_model(_OPC_R1_HISTOGRAM_MODEL)
-        self._pm_model = _data_model(_OPC_R1_PM_MODEL)
+    _histogram_model = _MODEL_REGISTRY['OPCR1Histogram']
+    _pm_model = _MODEL_REGISTRY['OPCR1PM']
 
     def on(self):
         """Power on peripherals (both laser and fan).
@@ -681,12 +2255,12 @@ class OPCR1(_OPC):
         absorption peak to pass before sending more commands.
 
         """
-        self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [0x03])
+        return self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [0x03])
 
     def off(self):
         """Power off peripherals (both laser and fan)."""
 
-        self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [0x00])
+        return self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [0x00])
 
     def reset(self):
         """Reset device.
@@ -695,12 +2269,16 @@ class OPCR1(_OPC):
         manufacturer docs.
 
         """
+        self.invalidate_capabilities()
         return self._send_command_and_wait(_OPC_CMD_RESET)
 
     def _histogram_post_process(self, hist):
-        """Convert histogram raw data into proper measurements."""
-        hist['Temperature'] = self._convert_temperature(hist['Temperature'])
-        hist['Relative humidity'] = self._convert_humidity(hist['Relative humidity'])
+        """Convert histogram raw data into proper measurements. Fields
+        missing from partial histograms are skipped."""
+        if 'Temperature' in hist:
+            hist['Temperature'] = self._convert_temperature(hist['Temperature'])
+        if 'Relative humidity' in hist:
+            hist['Relative humidity'] = self._convert_humidity(hist['Relative humidity'])
 
         hist = self._convert_hist_to_count_per_ml(hist)
         hist = self._convert_mtof(hist)
@@ -709,18 +2287,28 @@ class OPCR1(_OPC):
 
 
 class OPCR2(OPCR1):
-    def pm(self):
-        """Query particle mass readings."""
-        major, minor = super().fwversion()
+    _commands_need_fwversion = True
+
+    def _commands_for(self, fwversion):
+        """READ_PM doesn't work on firmwares before 2.82, nor is it
+        used if the firmware version is unknown (None)"""
+        if fwversion is None:
+            return self._commands - {_OPC_CMD_READ_PM}
+        major, minor = fwversion
         if (major <= 2) and (minor < 82):
             logger.warning('Querying PM from full histogram.')
             logger.warning('READ_PM command does not work on firmwares before 2.82.')
             logger.warning('Please consider a firmware upgrade.')
             logger.warning('Contact Alphasense for more info.')
-            hist = super().histogram()
-            return {k: v for k, v in hist.items() if k in ["PM1", "PM2.5", "PM10"]}
-        else:
-            return super().pm()
+            return self._commands - {_OPC_CMD_READ_PM}
+        return self._commands
+
+    def pm(self, from_histogram=False):
+        """Query particle mass readings, see :meth:`_OPC.pm`. Always
+        read from a histogram on firmwares before 2.82."""
+        if not from_histogram and not self.supports(_OPC_CMD_READ_PM):
+            from_histogram = True
+        return super().pm(from_histogram)
 
 
 class OPCN2(_OPC):
@@ -729,13 +2317,13 @@ class OPCN2(_OPC):
     Experimental support, only tested with firmware 18
 
     :param spi: a SPI device as returned by SpiDev or USBiss
+    :param kwargs: transfer options, see :class:`_OPC`
     """
-    def __init__(self, spi):
-        super().__init__(spi)
+    _commands = _OPC._commands | {_OPC_CMD_READ_POWER_STATE}
 
-        self._histogram_model = _data_model(_OPC_N2_HISTOGRAM_MODEL)
-        self._popt_model = _data_model(_OPC_N2_POPT_MODEL)
-        self._pm_model = _data_model(_OPC_N2_PM_MODEL)
+    _histogram_model = _MODEL_REGISTRY['OPCN2Histogram']
+    _popt_model = _MODEL_REGISTRY['OPCN2PowerState']
+    _pm_model = _MODEL_REGISTRY['OPCN2PM']
 
     def on(self):
         """Power on peripherals (laser and fan).
@@ -744,11 +2332,11 @@ class OPCN2(_OPC):
         peak to pass before sending more commands.
 
         """
-        self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [0x00])
+        return self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [0x00])
 
     def off(self):
         """Power off peripherals."""
-        self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [0x01])
+        return self._write_bytes(_OPC_CMD_WRITE_POWER_STATE, [0x01])
 
     def power_state(self):
         """Report peripherals and digital pots state.
@@ -762,12 +2350,19 @@ class OPCN2(_OPC):
         """
         return self._read_struct(_OPC_CMD_READ_POWER_STATE, self._popt_model)
 
+    def _checksum_fields(self, model):
+        """OPC-N2 checksum is computed from histogram bins"""
+        fields = super()._checksum_fields(model)
+        if fields:
+            fields = fields + list(model.bin_fields)
+        return fields
+
     def _checksum(self, data, raw_bytes):
         """Checksum calculation for OPC-N2.
 
         Return least significant 16bits of histogram bin sum.
         """
-        bins = [data[k] for k in data.keys() if 'Bin ' in k]
+        bins = [data[k] for k in self._histogram_model.bin_fields]
         binsum = 0
         for b in bins:
             binsum += b
@@ -775,6 +2370,29 @@ class OPCN2(_OPC):
         # checksum is the least significant dword of the binned data sum
         return binsum & 0xFFFF
 
+    def verify_checksums(self, frames, model=None):
+        """Verify checksums of many raw frames at once, e.g. from an
+        archive of raw histograms.
+
+        :param frames: a list of raw frames or a buffer of concatenated
+                       frames
+        :param model: data model of the frames (default: histogram)
+
+        :returns: a list of booleans, True where the checksum matches
+        """
+        model = model or self._histogram_model
+        if not isinstance(frames, (bytes, bytearray, memoryview)):
+            frames = b''.join(frames)
+        if np is not None:
+            data = model.unpack_array(frames)
+            binsum = sum(data[f].astype(np.uint32) for f in model.bin_fields)
+            return ((binsum & 0xFFFF) == data['Checksum']).tolist()
+        result = []
+        for i in range(0, len(frames), model.size):
+            data = model.unpack(frames[i:i + model.size])
+            result += [data['Checksum'] == self._checksum(data, None)]
+        return result
+
     def _histogram_post_process(self, hist):
         """Convert raw histogram data to measurements."""
 
@@ -791,29 +2409,290 @@ class OPCN2(_OPC):
         return hist
 
 
-def detect(spi):
+def _per_bus(items, spi, func):
+    """Call func on many items concurrently across SPI objects, one
+    thread each, while items sharing the same SPI object are handled
+    one after the other.
+
+    :param items: items to handle, e.g. devices
+    :param spi: function returning the SPI object of an item
+    :param func: called as ``func(item)``
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(id(spi(item)), []).append(item)
+
+    def run(group):
+        for item in group:
+            func(item)
+
+    threads = [threading.Thread(target=run, args=(group,)) for group in groups.values()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def update_configs(updates, force=False):
+    """Update configuration of many devices in parallel.
+
+    Devices on different SPI objects are updated concurrently, one
+    thread each, while devices sharing the same SPI object are updated
+    one after the other.
+
+    :param updates: a dictionary mapping devices to the configuration
+                    values to update, see :meth:`_OPC.update_config`
+    :param force: write configuration even if unchanged
+
+    :returns: a dictionary mapping devices to True if their
+              configuration was written
+    """
+    results = {}
+
+    def update(dev):
+        try:
+            results[dev] = dev.update_config(updates[dev], force=force)
+        except Exception as e:
+            logger.error('Could not update configuration of {}: {}'.format(dev, e))
+            results[dev] = False
+
+    _per_bus(updates, lambda dev: dev.spi, update)
+    return results
+
+
+# info string tag -> device class, in detection order
+_DEVICE_TYPES = [('OPC-N3', OPCN3), ('OPC-R1', OPCR1), ('OPC-R2', OPCR2), ('OPC-N2', OPCN2)]
+_DEVICE_CLASSES = {cls.__name__: cls for tag, cls in _DEVICE_TYPES}
+
+
+def _device_class(info):
+    """Device class matching an information string, or None"""
+    for tag, cls in _DEVICE_TYPES:
+        if tag in info:
+            return cls
+    return None
+
+
+class DetectionResult(object):
+    """Outcome of a device detection, true if a device was detected.
+
+    :ivar key: detection cache key, e.g. a (bus, chip select) tuple
+    :ivar device: the detected device instance, None on failure
+    :ivar info: device information string, as cached if :attr:`cached`
+    :ivar serial: device serial, if known
+    :ivar fwversion: device firmware version, if known
+    :ivar cached: True if the device was identified from the cache
+    :ivar error: reason of the failure, None on success
+    :ivar elapsed: detection time (s)
+    """
+    __slots__ = ('key', 'device', 'info', 'serial', 'fwversion', 'cached', 'error', 'elapsed')
+
+    def __init__(self, key=None):
+        self.key = key
+        self.device = None
+        self.info = None
+        self.serial = None
+        self.fwversion = None
+        self.cached = False
+        self.error = None
+        self.elapsed = 0.
+
+    def __bool__(self):
+        return self.device is not None
+
+    def __repr__(self):
+        return ('DetectionResult(key={!r}, device={}, cached={}, error={!r}, elapsed={:.6f})'
+                .format(self.key, type(self.device).__name__ if self.device else None,
+                        self.cached, self.error, self.elapsed))
+
+
+class DetectionCache(object):
+    """Detected device types, keyed by bus and chip select, optionally
+    persisted to a JSON file.
+
+    A cached entry is only trusted after a cheap check (firmware
+    version or serial, see :func:`probe`) confirms the same device is
+    still there.
+
+    :param path: JSON file, loaded if it exists (default: don't persist)
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning('Ignoring invalid detection cache {}: {}'.format(path, e))
+
+    def get(self, key):
+        """Cached entry for key, or None"""
+        return self.entries.get(str(key))
+
+    def put(self, key, result):
+        """Store a successful :class:`DetectionResult`"""
+        entry = {'type': type(result.device).__name__,
+                 'info': result.info,
+                 'serial': result.serial,
+                 'fwversion': list(result.fwversion) if result.fwversion else None}
+        with self._lock:
+            self.entries[str(key)] = entry
+            self.dirty = True
+
+    def remove(self, key):
+        """Forget the device at key"""
+        with self._lock:
+            if self.entries.pop(str(key), None) is not None:
+                self.dirty = True
+
+    def save(self):
+        """Write entries to the cache file, if changed"""
+        if self.path is None or not self.dirty:
+            return
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp, self.path)
+            self.dirty = False
+
+
+def _probe_cached(spi, entry, verify, result, kwargs):
+    """Identify a device from a cache entry with a cheap query"""
+    cls = _DEVICE_CLASSES.get(entry.get('type'))
+    if cls is None:
+        return
+    o = cls(spi, **kwargs)
+    if verify == 'serial':
+        serial = o.serial()
+        match = entry.get('serial') and serial == entry['serial']
+    else:
+        fwversion = o.fwversion()
+        match = entry.get('fwversion') and fwversion and list(fwversion) == entry['fwversion']
+
+    if not match:
+        logger.info('Cached device {} not found, detecting from info string'.format(entry['type']))
+        return
+
+    result.device = o
+    result.info = entry.get('info')
+    result.cached = True
+    # only the value just read back is known to be current, other
+    # queries must hit the device
+    if verify == 'serial':
+        result.serial = o.capabilities['serial'] = serial
+    else:
+        result.fwversion = o.capabilities['fwversion'] = fwversion
+
+
+def _probe_info(spi, result, verify, cache, kwargs):
+    """Detect a device parsing its information string"""
+    info = _OPC(spi, **kwargs).info()
+    result.info = info
+    logger.info('Detecting device type from info string: "{}"'.format(info))
+    if not info.strip('\0\xff '):
+        result.error = 'no response'
+        return
+    cls = _device_class(info)
+    if cls is None:
+        result.error = 'unknown device: "{}"'.format(info.strip())
+        return
+
+    o = cls(spi, **kwargs)
+    o.capabilities['info'] = info
+    if cache is not None:
+        # needed to validate the cache entry next time
+        result.fwversion = o.cached('fwversion')
+        if verify == 'serial':
+            result.serial = o.cached('serial')
+    result.device = o
+
+
+def probe(spi, key=None, cache=None, verify='fwversion', **kwargs):
+    """Detect a device, reporting why detection failed.
+
+    With a cache entry for key, the device is identified by reading
+    only its firmware version (2 bytes) or serial, instead of the full
+    information string. A mismatch falls back to a full detection and
+    updates the cache.
+
+    :param spi: SPI device instance as returned by SpiDev or USBiss
+    :param key: cache key of the device, e.g. a (bus, chip select) tuple
+    :param cache: a :class:`DetectionCache`
+    :param verify: 'fwversion' or 'serial', the query validating a
+                   cache entry
+    :param kwargs: transfer options passed to the device constructor
+
+    :returns: a :class:`DetectionResult`
+    """
+    result = DetectionResult(key)
+    start = monotonic()
+    if key is None:
+        cache = None
+    try:
+        entry = cache.get(key) if cache is not None else None
+        if entry is not None:
+            _probe_cached(spi, entry, verify, result, kwargs)
+        if result.device is None:
+            _probe_info(spi, result, verify, cache, kwargs)
+    except Exception as e:
+        result.device = None
+        result.error = 'error querying device: {}'.format(e)
+    result.elapsed = monotonic() - start
+
+    if result.device is not None:
+        logger.info('Detected an istance of: {}'.format(type(result.device)))
+        if cache is not None and not result.cached:
+            cache.put(key, result)
+    else:
+        logger.error('Could not detect a valid OPC device: {}'.format(result.error))
+        if cache is not None:
+            cache.remove(key)
+    return result
+
+
+def detect(spi, **kwargs):
     """Try to autodetect a device parsing information string
 
     :param spi: SPI device instance as returned by SpiDev or USBiss
+    :param kwargs: transfer options passed to the device constructor
 
     :returns: an OPC_(N3,N2,R1,R2) instance, check type() to see if the device was properly detected.
     """
-    o = _OPC(spi)
-    info = o.info()
-    logger.info('Detecting device type from info string: "{}"'.format(info))
-    if "OPC-N3" in info:
-        o = OPCN3(spi)
-    elif "OPC-R1" in info:
-        o = OPCR1(spi)
-    elif "OPC-R2" in info:
-        o = OPCR2(spi)
-    elif "OPC-N2" in info:
-        o = OPCN2(spi)
-    else:
-        o = None
+    return probe(spi, **kwargs).device
 
-    if o:
-        logger.info('Detected an istance of: {}'.format(type(o)))
-    else:
-        logger.error('Could not detect a valid OPC device')
-    return o
+
+def detect_all(spis, cache=None, verify='fwversion', **kwargs):
+    """Detect many devices in parallel, see :func:`probe`. Devices
+    sharing the same SPI object are probed one after the other.
+
+    :param spis: a dictionary mapping cache keys, e.g. (bus, chip
+                 select) tuples, to SPI devices, or a list of SPI
+                 devices (keyed by their index)
+    :param cache: a :class:`DetectionCache` or the path of its JSON
+                  file, saved after detection
+    :param verify: 'fwversion' or 'serial', the query validating cache
+                   entries
+    :param kwargs: transfer options passed to the device constructors
+
+    :returns: a dictionary mapping keys to :class:`DetectionResult`,
+              in input order
+    """
+    if not isinstance(spis, dict):
+        spis = dict(enumerate(spis))
+    if isinstance(cache, str):
+        cache = DetectionCache(cache)
+
+    results = {}
+
+    def run(key):
+        results[key] = probe(spis[key], key=key, cache=cache, verify=verify, **kwargs)
+
+    _per_bus(spis, spis.get, run)
+
+    if cache is not None:
+        cache.save()
+    return {key: results[key] for key in spis}
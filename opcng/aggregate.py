@@ -0,0 +1,301 @@
+"""Rolling statistics of samples from many devices.
+
+:class:`Aggregator` consumes samples (dictionaries as returned by e.g.
+:meth:`opcng._OPC.histogram` or :meth:`opcng._OPC.pm`) and keeps, per
+device, field and window, the count, mean, variance, minimum and
+maximum over the last minute, quarter of an hour, hour etc., without
+storing samples.
+
+Each window is split in a fixed number of time buckets aligned to
+multiples of the bucket length, e.g. a 1 h window with 60 buckets uses
+1 min buckets starting at whole minutes. Memory only depends on the
+number of buckets and fields, not on the sampling rate, and samples of
+different devices falling in the same bucket are aligned.
+
+:Example:
+
+>>> from opcng.aggregate import Aggregator
+>>> from opcng.scheduler import Scheduler
+>>> agg = Aggregator(windows=(60, 900, 3600), fields=['PM1', 'PM2.5', 'PM10'])
+>>> s = Scheduler()
+>>> for dev in devs:
+...     s.add(dev, 1., agg)
+>>> s.start()
+>>> agg.means(900, 'PM2.5')
+{<opcng.OPCN3 object at ...>: 12.3, <opcng.OPCN3 object at ...>: 11.8}
+"""
+import math
+import threading
+from array import array
+
+_INF = float('inf')
+
+
+class WindowStats(object):
+    """Statistics of a field over a window.
+
+    :ivar count: number of samples
+    :ivar mean: mean value (nan if no samples)
+    :ivar m2: sum of squared deviations from the mean
+    :ivar min: minimum value
+    :ivar max: maximum value
+    """
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = math.nan
+        self.m2 = 0.
+        self.min = _INF
+        self.max = -_INF
+
+    def _merge(self, count, mean, m2, lo, hi):
+        """Merge the statistics of a bucket (Chan et al. parallel
+        variance)"""
+        if not count:
+            return
+        if not self.count:
+            self.count, self.mean, self.m2 = count, mean, m2
+        else:
+            n = self.count + count
+            delta = mean - self.mean
+            self.mean += delta * count / n
+            self.m2 += m2 + delta * delta * self.count * count / n
+            self.count = n
+        self.min = min(self.min, lo)
+        self.max = max(self.max, hi)
+
+    @property
+    def variance(self):
+        """Sample variance (nan with less than 2 samples)"""
+        if self.count < 2:
+            return math.nan
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        """Sample standard deviation"""
+        return math.sqrt(self.variance)
+
+    def __repr__(self):
+        return ('WindowStats(count={}, mean={:.6g}, std={:.6g}, min={:.6g}, max={:.6g})'
+                .format(self.count, self.mean, self.std, self.min, self.max))
+
+
+class _Bucket(object):
+    """Running statistics of all fields within a time bucket"""
+    __slots__ = ('index', 'count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self, nfields):
+        self.index = None
+        self.count = array('d', bytes(8 * nfields))
+        self.mean = array('d', bytes(8 * nfields))
+        self.m2 = array('d', bytes(8 * nfields))
+        self.min = array('d', [_INF]) * nfields
+        self.max = array('d', [-_INF]) * nfields
+
+    def reset(self, index):
+        n = len(self.count)
+        self.index = index
+        self.count[:] = array('d', bytes(8 * n))
+        self.mean[:] = array('d', bytes(8 * n))
+        self.m2[:] = array('d', bytes(8 * n))
+        self.min[:] = array('d', [_INF]) * n
+        self.max[:] = array('d', [-_INF]) * n
+
+
+class RollingWindow(object):
+    """Rolling statistics of many fields over a time window, for a
+    single device.
+
+    The window covers the bucket holding the latest timestamp and the
+    ``buckets - 1`` previous ones. Late samples are added to their own
+    bucket, samples older than the window are dropped.
+
+    :param length: window length in seconds
+    :param fields: names of the fields to aggregate
+    :param buckets: number of time buckets
+    """
+    def __init__(self, length, fields, buckets=60):
+        self.length = length
+        self.fields = tuple(fields)
+        self.resolution = length / buckets
+        self._index = {f: i for i, f in enumerate(self.fields)}
+        self._buckets = [_Bucket(len(self.fields)) for i in range(buckets)]
+        # index of the newest bucket so far
+        self._newest = None
+
+    def _bucket(self, timestamp):
+        """Bucket for timestamp, None if it's older than the window"""
+        index = int(timestamp // self.resolution)
+        if self._newest is None or index > self._newest:
+            self._newest = index
+        elif index <= self._newest - len(self._buckets):
+            return None
+        b = self._buckets[index % len(self._buckets)]
+        if b.index is None or index > b.index:
+            b.reset(index)
+        elif index < b.index:
+            return None
+        return b
+
+    def add(self, timestamp, sample):
+        """Add a sample.
+
+        :param timestamp: sample time in seconds, e.g. from time.time()
+        :param sample: a dictionary, fields not in :attr:`fields` and
+                       None values are ignored
+
+        :returns: False if the sample is older than the window and was
+                  dropped
+        """
+        b = self._bucket(timestamp)
+        if b is None:
+            return False
+        count, mean, m2, lo, hi = b.count, b.mean, b.m2, b.min, b.max
+        for i, f in enumerate(self.fields):
+            x = sample.get(f)
+            if x is None:
+                continue
+            n = count[i] + 1.
+            delta = x - mean[i]
+            mean[i] += delta / n
+            m2[i] += delta * (x - mean[i])
+            count[i] = n
+            if x < lo[i]:
+                lo[i] = x
+            if x > hi[i]:
+                hi[i] = x
+        return True
+
+    def _live(self, now):
+        """Buckets within the window ending at time now"""
+        last = int(now // self.resolution)
+        first = last - len(self._buckets)
+        return [b for b in self._buckets if b.index is not None and first < b.index <= last]
+
+    def stats(self, now, fields=None):
+        """Statistics over the window ending at time now.
+
+        :param now: window end time in seconds
+        :param fields: only these fields (default: all)
+
+        :returns: a dictionary mapping field names to :class:`WindowStats`
+        """
+        buckets = self._live(now)
+        result = {}
+        for f in fields or self.fields:
+            i = self._index[f]
+            s = result[f] = WindowStats()
+            for b in buckets:
+                s._merge(int(b.count[i]), b.mean[i], b.m2[i], b.min[i], b.max[i])
+        return result
+
+    def series(self, now, field):
+        """Per-bucket means of a field within the window.
+
+        :returns: a dictionary mapping bucket start times to mean values
+        """
+        i = self._index[field]
+        return {b.index * self.resolution: b.mean[i]
+                for b in sorted(self._live(now), key=lambda b: b.index) if b.count[i]}
+
+
+def _numeric_fields(sample):
+    return [f for f, v in sample.items()
+            if isinstance(v, (int, float)) and not isinstance(v, bool)]
+
+
+class Aggregator(object):
+    """Time-aligned rolling statistics of samples from many devices.
+
+    Instances can be used as :class:`opcng.scheduler.Scheduler`
+    callbacks.
+
+    :param windows: window lengths in seconds
+    :param buckets: number of time buckets per window, i.e. the time
+                    resolution is window / buckets
+    :param fields: names of the fields to aggregate (default: all
+                   numeric fields of the first sample of each device)
+    """
+    def __init__(self, windows=(60, 900, 3600), buckets=60, fields=None):
+        self.windows = tuple(windows)
+        self.buckets = buckets
+        self.fields = fields
+        self.latest = None
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, timestamp, sample):
+        """Add a sample.
+
+        :param key: device identifier, e.g. the device instance or its serial
+        :param timestamp: sample time in seconds, e.g. from time.time()
+        :param sample: a dictionary of field values
+        """
+        if sample is None:
+            return
+        with self._lock:
+            windows = self._devices.get(key)
+            if windows is None:
+                fields = self.fields or _numeric_fields(sample)
+                windows = self._devices[key] = [RollingWindow(w, fields, self.buckets)
+                                                for w in self.windows]
+            for w in windows:
+                w.add(timestamp, sample)
+            if self.latest is None or timestamp > self.latest:
+                self.latest = timestamp
+
+    def __call__(self, dev, sample, timestamp):
+        """Scheduler callback, see :meth:`opcng.scheduler.Scheduler.add`"""
+        self.add(dev, timestamp, sample)
+
+    @property
+    def devices(self):
+        """Devices seen so far"""
+        return list(self._devices)
+
+    def _window(self, key, window):
+        return self._devices[key][self.windows.index(window)]
+
+    def stats(self, window, key, now=None, fields=None):
+        """Statistics of a device over a window.
+
+        :param window: window length, one of :attr:`windows`
+        :param key: device identifier
+        :param now: window end time (default: latest sample timestamp
+                    of any device, so stale devices age out)
+        :param fields: only these fields (default: all)
+
+        :returns: a dictionary mapping field names to :class:`WindowStats`
+        """
+        with self._lock:
+            now = self.latest if now is None else now
+            return self._window(key, window).stats(now, fields)
+
+    def means(self, window, field, now=None):
+        """Mean of a field over a window for every device, see :meth:`stats`.
+
+        :returns: a dictionary mapping devices to mean values, nan for
+                  devices without samples in the window
+        """
+        with self._lock:
+            now = self.latest if now is None else now
+            return {key: self._window(key, window).stats(now, [field])[field].mean
+                    for key in self._devices}
+
+    def aligned(self, window, field, now=None):
+        """Per-bucket means of a field over a window, aligned across
+        devices.
+
+        :returns: a list of (bucket start time, {device: mean}) pairs
+                  sorted by time, devices without samples in a bucket
+                  are left out
+        """
+        with self._lock:
+            now = self.latest if now is None else now
+            rows = {}
+            for key in self._devices:
+                for t, mean in self._window(key, window).series(now, field).items():
+                    rows.setdefault(t, {})[key] = mean
+            return sorted(rows.items())
@@ -0,0 +1,379 @@
+"""Asyncio interface to Alphasense OPC devices.
+
+Same API as the blocking device classes, but every query is a
+coroutine: waits are done with ``asyncio.sleep`` and blocking SPI
+transfers run in an executor, so a single event loop can drive many
+devices concurrently.
+
+:Example:
+
+>>> import asyncio
+>>> from opcng.aio import AsyncOPCN3
+>>> async def main(spis):
+...     devs = [AsyncOPCN3(spi) for spi in spis]
+...     return await asyncio.gather(*[dev.histogram() for dev in devs])
+"""
+import asyncio
+import logging
+import time
+
+from . import (_OPCError, USBISSError, OPCN3, OPCR1, OPCR2, OPCN2,
+               _OPC_READY, _OPC_BUSY, _OPC_CMD_READ_INFO_STRING,
+               _OPC_CMD_READ_SERIAL_STRING, _OPC_CMD_READ_FW_VERSION,
+               _OPC_CMD_READ_HISTOGRAM, _OPC_CMD_READ_PM, _OPC_CMD_CHECK_STATUS,
+               _OPC_CMD_READ_CONFIG, _OPC_CMD_WRITE_CONFIG, _OPC_CMD_RESET,
+               _OPC, Transaction, _device_class)
+
+logger = logging.getLogger(__name__)
+
+
+class _AsyncOPC(object):
+    """Asyncio mixin, overrides device I/O with coroutines.
+
+    Must come before a device class in the bases list. Methods that
+    are a single I/O call in the device classes (e.g. ``pm()``,
+    ``power_state()``, ``off()``) are inherited unchanged and return
+    an awaitable.
+
+    :param spi: a SPI device as returned by SpiDev or USBiss
+    :param executor: executor for blocking SPI transfers (default: the
+                     event loop default executor)
+    :param lock: an asyncio.Lock serializing transactions. Devices
+                 sharing the same physical bus must share the same lock
+                 (default: one lock per device)
+    :param kwargs: transfer options, see :class:`opcng._OPC`
+    """
+    def __init__(self, spi, executor=None, lock=None, **kwargs):
+        super().__init__(spi, **kwargs)
+        self.executor = executor
+        self.lock = lock or asyncio.Lock()
+
+    async def _run(self, func, *args):
+        """Run a blocking call in the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def _send_command_and_wait(self, cmd, policy=None):
+        """Coroutine version of :meth:`opcng._OPC._send_command_and_wait`"""
+        policy = policy or self.wait_policy
+        r = _OPC_BUSY
+        attempts = 0
+        interval = policy.initial
+        start = time.monotonic()
+
+        while (r != _OPC_READY):
+            error = self._wait_check(cmd, r, attempts, start, policy)
+            if error:
+                raise error
+
+            r = await self._run(self._send_command, cmd, 0)
+            await asyncio.sleep(self._wait_interval(r, interval, policy))
+            interval = policy.next_interval(interval)
+
+            attempts = attempts + 1
+
+        self._record_wait(cmd, attempts, time.monotonic() - start)
+
+    async def _transaction(self, cmd, payload, *args):
+        """Handshake and transfer a data sequence holding the bus lock"""
+        async with self.lock:
+            await self._send_command_and_wait(cmd)
+            return await self._run(payload, *args)
+
+    async def _read_bytes(self, cmd, sz):
+        """Coroutine version of :meth:`opcng._OPC._read_bytes`"""
+        if not self._recovery_check(cmd):
+            return bytearray()
+
+        buf = []
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                buf = await self._transaction(cmd, self._read_payload, cmd, sz)
+            except (_OPCError, USBISSError) as e:
+                delay = self._recovery_failure(cmd, e, attempt)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                self._recovery_success(cmd)
+                if self.metrics is not None:
+                    self.metrics.transaction(cmd, time.monotonic() - start, nread=len(buf))
+                break
+
+        return self._check_read_size(cmd, buf, sz)
+
+    async def _write_bytes(self, cmd, buf):
+        """Coroutine version of :meth:`opcng._OPC._write_bytes`"""
+        if not self._recovery_check(cmd):
+            return False
+
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                await self._transaction(cmd, self._write_payload, buf)
+            except (_OPCError, USBISSError) as e:
+                delay = self._recovery_failure(cmd, e, attempt)
+                if delay is None:
+                    return False
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                self._recovery_success(cmd)
+                if self.metrics is not None:
+                    self.metrics.transaction(cmd, time.monotonic() - start, nwritten=len(buf))
+                return True
+
+    async def _read_struct(self, cmd, model):
+        """Coroutine version of :meth:`opcng._OPC._read_struct`"""
+        raw_bytes = await self._read_bytes(cmd, model.size)
+        return self._decode_struct(model, raw_bytes)
+
+    async def info(self):
+        """Query device information"""
+        buf = await self._read_bytes(_OPC_CMD_READ_INFO_STRING, 60)
+        return buf.decode()
+
+    async def serial(self):
+        """Query device serial"""
+        buf = await self._read_bytes(_OPC_CMD_READ_SERIAL_STRING, 60)
+        return buf.decode()
+
+    async def fwversion(self):
+        """Query device firmware version, see :meth:`opcng._OPC.fwversion`"""
+        buf = await self._read_bytes(_OPC_CMD_READ_FW_VERSION, 2)
+        if len(buf) != 2:
+            return None
+        major, minor = buf
+        return major, minor
+
+    async def ping(self):
+        """Check device status. Returns True if the device is responding."""
+        if not self.breaker.allow():
+            return False
+        try:
+            async with self.lock:
+                await self._send_command_and_wait(_OPC_CMD_CHECK_STATUS)
+        except (Exception, USBISSError) as e:
+            self._recovery_failure(_OPC_CMD_CHECK_STATUS, e, self.recovery.retries)
+            return False
+        self._recovery_success(_OPC_CMD_CHECK_STATUS)
+        return True
+
+    async def histogram(self, raw=False, fields=None):
+        """Query and decode histogram data, see :meth:`opcng._OPC.histogram`"""
+        if fields is None:
+            data = await self._read_struct(_OPC_CMD_READ_HISTOGRAM, self._histogram_model)
+            return self._finish_histogram(data, raw)
+
+        decode, output = self._histogram_fields(fields, raw)
+        raw_bytes = await self._read_bytes(_OPC_CMD_READ_HISTOGRAM, self._histogram_model.size)
+        data = self._decode_struct(self._histogram_model, raw_bytes, decode)
+        return self._finish_histogram(data, raw, output)
+
+    async def sample(self, engine=None):
+        """Read a histogram and PM values with a single histogram read,
+        see :meth:`opcng._OPC.sample`"""
+        return self._sample(await self.histogram(), engine)
+
+    def stream(self, period=1., raw=False, count=None):
+        """Acquire histograms periodically, async iterator version of
+        :meth:`opcng._OPC.stream` (without ring buffer).
+
+        :param period: sampling period in seconds, must be positive
+        :param raw: if True yield raw bytes instead of decoded and post
+                    processed histograms
+        :param count: stop after count samples (default: never)
+        """
+        if not period > 0:
+            raise ValueError('Sampling period must be positive, got {}'.format(period))
+        return self._stream_async(period, raw, count)
+
+    async def _stream_async(self, period, raw, count):
+        loop = asyncio.get_running_loop()
+        next_t = loop.time()
+        n = 0
+        while count is None or n < count:
+            delay = next_t - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -period:
+                # the consumer fell behind: skip missed periods
+                next_t += (-delay // period) * period
+            next_t += period
+
+            timestamp = time.time()
+            raw_bytes = await self._read_bytes(_OPC_CMD_READ_HISTOGRAM, self._histogram_model.size)
+            data = self._decode_struct(self._histogram_model, raw_bytes)
+            if data is None:
+                continue
+            n += 1
+            if raw:
+                yield timestamp, bytes(raw_bytes)
+            else:
+                yield timestamp, self._histogram_post_process(data)
+
+    async def read_config(self, cached=False):
+        """Query configuration variables, see :meth:`opcng._OPC.read_config`"""
+        if not hasattr(self, '_read_config_model'):
+            logger.warning("read_config not supported for {}".format(type(self)))
+            return None
+
+        if cached and self._config is not None:
+            return dict(self._config)
+
+        config = await self._read_struct(_OPC_CMD_READ_CONFIG, self._read_config_model)
+        self._config = None if config is None else dict(config)
+        return config
+
+    async def update_config(self, update_dict, force=False):
+        """Update configuration variables, see :meth:`opcng._OPC.update_config`"""
+        if not hasattr(self, '_write_config_model'):
+            logger.warning("update_config not supported for {}".format(type(self)))
+            return False
+
+        config_dict = await self.read_config(cached=True)
+        if config_dict is None:
+            logger.error("Could not read current configuration")
+            return False
+
+        values = self._merge_config(config_dict, update_dict)
+        if not force and not self._config_changed(config_dict, values):
+            logger.info("Configuration unchanged, skipping write")
+            return False
+
+        if not await self._write_struct(_OPC_CMD_WRITE_CONFIG,
+                                        self._write_config_model, values):
+            logger.error("Could not write configuration")
+            self._config = None
+            return False
+        self._store_config(values)
+
+        # see opcng._OPC.update_config
+        await asyncio.sleep(1)
+        while not await self.ping():
+            if self.metrics is not None:
+                self.metrics.event('retry', _OPC_CMD_CHECK_STATUS)
+            await asyncio.sleep(1)
+
+        return True
+
+    async def cached(self, name):
+        """Get a device property, see :meth:`opcng._OPC.cached`"""
+        if name not in self.capabilities:
+            if name == 'commands':
+                fwversion = await self.cached('fwversion') if self._commands_need_fwversion else None
+                if self._commands_need_fwversion and fwversion is None:
+                    # see opcng._OPC.cached
+                    return self._commands_for(None)
+                value = self._commands_for(fwversion)
+            else:
+                value = await getattr(self, name)()
+            if not value:
+                # failed query, don't cache it
+                return value
+            self.capabilities[name] = value
+        return self.capabilities[name]
+
+    async def supports(self, cmd):
+        """Check if the device supports a command opcode"""
+        return cmd in await self.cached('commands')
+
+    async def reset(self):
+        """Reset device."""
+        self.invalidate_capabilities()
+        async with self.lock:
+            await self._send_command_and_wait(_OPC_CMD_RESET)
+
+    def transaction(self, ready_delay=0.):
+        """Start a batch of reads, see :meth:`opcng._OPC.transaction`"""
+        return AsyncTransaction(self, ready_delay)
+
+
+class AsyncTransaction(Transaction):
+    """Asyncio :class:`opcng.Transaction`: the whole batch runs in the
+    executor in one go, holding the bus lock"""
+    async def run(self):
+        """Run the queued reads, see :meth:`opcng.Transaction.run`"""
+        read_pm = await self.dev.supports(_OPC_CMD_READ_PM) if self._needs_pm_check() else True
+        plan = self._plan(read_pm)
+        async with self.dev.lock:
+            return await self.dev._run(self._execute, plan)
+
+
+class AsyncOPCN3(_AsyncOPC, OPCN3):
+    """Asyncio OPC-N3, see :class:`opcng.OPCN3` and :class:`_AsyncOPC`"""
+    async def on(self):
+        """Power on peripherals (both laser and fan)."""
+        await self.laser_on()
+        await self.fan_on()
+
+    async def off(self):
+        """Power off peripherals (both laser and fan)."""
+        await self.laser_off()
+        await self.fan_off()
+
+
+class AsyncOPCR1(_AsyncOPC, OPCR1):
+    """Asyncio OPC-R1, see :class:`opcng.OPCR1` and :class:`_AsyncOPC`"""
+    pass
+
+
+class AsyncOPCR2(_AsyncOPC, OPCR2):
+    """Asyncio OPC-R2, see :class:`opcng.OPCR2` and :class:`_AsyncOPC`"""
+    async def pm(self, from_histogram=False):
+        """Query particle mass readings, see :meth:`opcng.OPCR2.pm`"""
+        if not from_histogram and not await self.supports(_OPC_CMD_READ_PM):
+            from_histogram = True
+        # skip OPCR2.pm, its capability check is synchronous
+        return await OPCR1.pm(self, from_histogram)
+
+
+class AsyncOPCN2(_AsyncOPC, OPCN2):
+    """Asyncio OPC-N2, see :class:`opcng.OPCN2` and :class:`_AsyncOPC`"""
+    pass
+
+
+async def update_configs(updates, force=False):
+    """Update configuration of many devices concurrently, see
+    :func:`opcng.update_configs`. Devices sharing a bus are serialized
+    by their shared lock.
+
+    :returns: a dictionary mapping devices to True if their
+              configuration was written
+    """
+    devs = list(updates)
+    results = await asyncio.gather(*[dev.update_config(updates[dev], force=force) for dev in devs])
+    return dict(zip(devs, results))
+
+
+class _AsyncProbe(_AsyncOPC, _OPC):
+    pass
+
+
+# device class -> asyncio device class
+_ASYNC_CLASSES = {OPCN3: AsyncOPCN3, OPCR1: AsyncOPCR1, OPCR2: AsyncOPCR2, OPCN2: AsyncOPCN2}
+
+
+async def detect(spi, **kwargs):
+    """Try to autodetect a device parsing information string, see
+    :func:`opcng.detect`
+
+    :param spi: SPI device instance as returned by SpiDev or USBiss
+    :param kwargs: options passed to the device constructor
+
+    :returns: an AsyncOPC_(N3,N2,R1,R2) instance or None
+    """
+    info = await _AsyncProbe(spi, **kwargs).info()
+    logger.info('Detecting device type from info string: "{}"'.format(info))
+    cls = _device_class(info)
+    o = _ASYNC_CLASSES[cls](spi, **kwargs) if cls is not None else None
+
+    if o:
+        logger.info('Detected an istance of: {}'.format(type(o)))
+    else:
+        logger.error('Could not detect a valid OPC device')
+    return o
@@ -0,0 +1,211 @@
+"""Decode raw OPC frames without a device.
+
+Raw frames (e.g. from a :class:`opcng.record.Recording` or any other
+archive) are decoded by model name, with the same checksum
+verification and post processing as the device classes, but no SPI
+bus involved.
+
+:func:`decode_parallel` splits a large archive across a process pool:
+input frames and output records live in shared memory blocks, so
+workers neither pickle frames nor results. Requires numpy.
+
+:Example:
+
+>>> from opcng.decode import decode, decode_parallel
+>>> decode('OPCN3Histogram', raw)['PM2.5']
+>>> hists = decode_parallel('OPCN3Histogram', frames, processes=8)
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from . import np, OPCN3, OPCR1, OPCN2
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+logger = logging.getLogger(__name__)
+
+# model name -> (device class, model attribute), names as in opcng.record
+_MODELS = {'OPCN3Histogram':  (OPCN3, '_histogram_model'),
+           'OPCR1Histogram':  (OPCR1, '_histogram_model'),
+           'OPCN2Histogram':  (OPCN2, '_histogram_model'),
+           'OPCN3PM':         (OPCN3, '_pm_model'),
+           'OPCR1PM':         (OPCR1, '_pm_model'),
+           'OPCN2PM':         (OPCN2, '_pm_model'),
+           'OPCN3PowerState': (OPCN3, '_popt_model'),
+           'OPCN2PowerState': (OPCN2, '_popt_model'),
+           'OPCN3Config':     (OPCN3, '_read_config_model')}
+
+# offline device instances, one per class
+_decoders = {}
+
+
+def decoder(model_name):
+    """Get a device instance able to decode a model, not bound to any
+    SPI bus, and the data model.
+
+    :param model_name: model name, e.g. 'OPCN3Histogram'
+
+    :returns: a (device, model) pair
+    """
+    if model_name not in _MODELS:
+        raise ValueError('Unknown model: {}'.format(model_name))
+    cls, attr = _MODELS[model_name]
+    dev = _decoders.get(cls)
+    if dev is None:
+        dev = _decoders[cls] = cls(None)
+    return dev, getattr(dev, attr)
+
+
+def _is_histogram(dev, model):
+    return model is dev._histogram_model
+
+
+def decode(model_name, raw_bytes, raw=False):
+    """Decode a single raw frame.
+
+    :param model_name: model name, e.g. 'OPCN3Histogram'
+    :param raw_bytes: the raw frame
+    :param raw: if True do not post process histograms
+
+    :returns: a dictionary, or None if the frame size or checksum is
+              invalid
+    """
+    dev, model = decoder(model_name)
+    data = dev._decode_struct(model, raw_bytes)
+    if _is_histogram(dev, model):
+        return dev._finish_histogram(data, raw)
+    return data
+
+
+def _valid(dev, model, raw_bytes):
+    """Checksum mask of concatenated frames, None if the model has no
+    checksum"""
+    if not model.has_checksum:
+        return None
+    return np.array(dev.verify_checksums(raw_bytes, model), dtype=bool)
+
+
+def output_dtype(model_name, raw=False):
+    """Structured dtype of the records returned by :func:`decode_batch`"""
+    dev, model = decoder(model_name)
+    if raw or not _is_histogram(dev, model):
+        return model.dtype
+    return np.dtype([(f, np.float64) for f in model.fields])
+
+
+def decode_batch(model_name, frames, raw=False, check=True):
+    """Decode many raw frames at once. Requires numpy.
+
+    :param model_name: model name, e.g. 'OPCN3Histogram'
+    :param frames: a buffer of concatenated raw frames or a list of raw
+                   frames
+    :param raw: if True do not post process histograms
+    :param check: if True drop frames with invalid checksum
+
+    :returns: a structured array, see :func:`output_dtype`
+    """
+    if np is None:
+        raise ImportError('numpy is required for batch decoding')
+    dev, model = decoder(model_name)
+    if not isinstance(frames, (bytes, bytearray, memoryview)):
+        frames = b''.join(frames)
+
+    if _is_histogram(dev, model):
+        return dev.histogram_batch(frames, raw=raw, check=check)
+
+    data = model.unpack_array(frames)
+    valid = _valid(dev, model, frames) if check else None
+    if valid is not None and not valid.all():
+        logger.warning('Dropping {} frames with invalid checksum'.format((~valid).sum()))
+        data = data[valid]
+    return data.copy()
+
+
+def _decode_chunk(model_name, frames_name, out_name, valid_name, n, start, stop, raw):
+    """Process pool worker: decode frames [start, stop) from shared
+    memory into the shared output array"""
+    dev, model = decoder(model_name)
+    frames_shm = shared_memory.SharedMemory(frames_name)
+    out_shm = shared_memory.SharedMemory(out_name)
+    valid_shm = shared_memory.SharedMemory(valid_name)
+    try:
+        frames = frames_shm.buf[start * model.size:stop * model.size]
+        out = np.ndarray(n, dtype=output_dtype(model_name, raw), buffer=out_shm.buf)
+        valid = np.ndarray(n, dtype=bool, buffer=valid_shm.buf)
+
+        out[start:stop] = decode_batch(model_name, frames, raw=raw, check=False)
+        checked = _valid(dev, model, frames)
+        valid[start:stop] = True if checked is None else checked
+
+        # views must be released before closing shared memory
+        del frames, out, valid
+    finally:
+        frames_shm.close()
+        out_shm.close()
+        valid_shm.close()
+    return stop - start
+
+
+def decode_parallel(model_name, frames, processes=None, chunk_size=65536,
+                    raw=False, check=True):
+    """Decode a large buffer of raw frames on a process pool, see
+    :func:`decode_batch`. Requires numpy.
+
+    Frames are copied once to a shared memory block, each worker
+    decodes ``chunk_size`` frames straight into a shared output array.
+
+    :param model_name: model name, e.g. 'OPCN3Histogram'
+    :param frames: a buffer of concatenated raw frames or a list of raw
+                   frames
+    :param processes: number of worker processes (default: number of CPUs)
+    :param chunk_size: number of frames per work unit
+    :param raw: if True do not post process histograms
+    :param check: if True drop frames with invalid checksum
+
+    :returns: a structured array, see :func:`output_dtype`
+    """
+    if np is None or shared_memory is None:
+        raise ImportError('numpy and multiprocessing.shared_memory are required '
+                          'for parallel decoding')
+    dev, model = decoder(model_name)
+    if not isinstance(frames, (bytes, bytearray, memoryview)):
+        frames = b''.join(frames)
+    frames = memoryview(frames).cast('B')
+    n = len(frames) // model.size
+    if n * model.size != len(frames):
+        raise ValueError('Buffer size is not a multiple of the frame size ({})'.format(model.size))
+
+    processes = processes or os.cpu_count()
+    if n <= chunk_size or processes == 1:
+        return decode_batch(model_name, frames, raw=raw, check=check)
+
+    dtype = output_dtype(model_name, raw)
+    frames_shm = shared_memory.SharedMemory(create=True, size=len(frames))
+    out_shm = shared_memory.SharedMemory(create=True, size=n * dtype.itemsize)
+    valid_shm = shared_memory.SharedMemory(create=True, size=n)
+    try:
+        frames_shm.buf[:len(frames)] = frames
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            jobs = [pool.submit(_decode_chunk, model_name, frames_shm.name, out_shm.name,
+                                valid_shm.name, n, start, min(start + chunk_size, n), raw)
+                    for start in range(0, n, chunk_size)]
+            for job in jobs:
+                job.result()
+
+        out = np.ndarray(n, dtype=dtype, buffer=out_shm.buf)
+        valid = np.ndarray(n, dtype=bool, buffer=valid_shm.buf)
+        if check and not valid.all():
+            logger.warning('Dropping {} frames with invalid checksum'.format((~valid).sum()))
+            result = out[valid]
+        else:
+            result = out.copy()
+        del out, valid
+        return result
+    finally:
+        for shm in (frames_shm, out_shm, valid_shm):
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,281 @@
+"""Simulated SPI backend emulating OPC devices.
+
+:class:`SimulatedSPI` has the same ``xfer`` interface as SpiDev and
+USBiss and emulates the OPC SPI protocol byte by byte: busy/ready
+handshake, command opcodes, checksummed histogram and PM frames,
+configuration read/write and power state. Latency and faults can be
+injected to test error paths and load-test the library without
+hardware.
+
+:Example:
+
+>>> import opcng
+>>> from opcng.emulator import SimulatedSPI
+>>> dev = opcng.detect(SimulatedSPI('N3'))
+>>> dev.histogram()['PM2.5']
+"""
+import random
+import struct
+from time import sleep
+
+from . import (_MODEL_REGISTRY, _crc16, USBISSError, _OPC_READY, _OPC_BUSY,
+               _OPC_N3_POPT_FAN_POT, _OPC_N3_POPT_LASER_SWITCH,
+               _OPC_CMD_WRITE_POWER_STATE, _OPC_CMD_READ_POWER_STATE,
+               _OPC_CMD_READ_INFO_STRING, _OPC_CMD_READ_SERIAL_STRING,
+               _OPC_CMD_READ_FW_VERSION, _OPC_CMD_READ_HISTOGRAM,
+               _OPC_CMD_READ_PM, _OPC_CMD_READ_CONFIG, _OPC_CMD_WRITE_CONFIG,
+               _OPC_CMD_RESET)
+
+# Per device emulation parameters
+_DEVICES = {
+    'N3': {'info': 'OPC-N3 Iss1.1 FirmwareVer=1.17a...........................BS',
+           'fwversion': (1, 17),
+           'histogram': 'OPCN3Histogram',
+           'pm': 'OPCN3PM',
+           'popt': 'OPCN3PowerState',
+           'read_config': 'OPCN3Config',
+           'write_config': 'OPCN3WriteConfig',
+           'busy': True},
+    'R1': {'info': 'OPC-R1 Iss1.0 FirmwareVer=2.10..........................BS',
+           'fwversion': (2, 10),
+           'histogram': 'OPCR1Histogram',
+           'pm': 'OPCR1PM',
+           'busy': True},
+    'R2': {'info': 'OPC-R2 Iss1.0 FirmwareVer=2.90..........................BS',
+           'fwversion': (2, 90),
+           'histogram': 'OPCR1Histogram',
+           'pm': 'OPCR1PM',
+           'busy': True},
+    'N2': {'info': 'OPC-N2 FirmwareVer=OPC-018.2..............................BD',
+           'fwversion': (18, 2),
+           'histogram': 'OPCN2Histogram',
+           'pm': 'OPCN2PM',
+           'popt': 'OPCN2PowerState',
+           'busy': False},
+}
+
+# Bytes exchanged after a write command handshake
+_WRITE_SIZES = {_OPC_CMD_WRITE_POWER_STATE: 1}
+
+
+class SimulatedSPI(object):
+    """Fake SPI device emulating an Alphasense OPC.
+
+    :param kind: emulated device, one of 'N3', 'R1', 'R2' or 'N2'
+    :param serial: serial number string
+    :param fwversion: (major, minor) firmware version (default: per device)
+    :param busy_polls: busy responses before a command is ready
+                       (N2 is always ready)
+    :param latency: seconds spent in each ``xfer`` call, e.g. to
+                    emulate a USB-SPI round trip
+    :param corrupt_rate: probability of corrupting a data frame (bad
+                         checksum)
+    :param unexpected_rate: probability of an unexpected handshake response
+    :param error_rate: probability of an ``xfer`` call raising USBISSError
+    :param seed: random seed
+    """
+    def __init__(self, kind='N3', serial=None, fwversion=None, busy_polls=1,
+                 latency=0., corrupt_rate=0., unexpected_rate=0., error_rate=0.,
+                 seed=None):
+        if kind not in _DEVICES:
+            raise ValueError('Unknown device kind: {}'.format(kind))
+        self.kind = kind
+        self.params = _DEVICES[kind]
+        self.fwversion = fwversion or self.params['fwversion']
+        self.busy_polls = busy_polls
+        self.latency = latency
+        self.corrupt_rate = corrupt_rate
+        self.unexpected_rate = unexpected_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.serial = serial or 'OPC-{} {:09d}'.format(kind, self.random.randrange(10 ** 9))
+
+        self.models = {k: _MODEL_REGISTRY[self.params[k]] for k in
+                       ('histogram', 'pm', 'popt', 'read_config', 'write_config')
+                       if k in self.params}
+
+        self.fan = False
+        self.laser = False
+        self.config = self._default_config() if 'read_config' in self.models else None
+
+        # statistics
+        self.transfers = 0
+        self.commands = {}
+
+        self._cmd = None
+        self._polls = 0
+        self._tx = []
+        self._rx = 0
+        self._rx_cmd = None
+        self._rx_buf = []
+
+    def _default_config(self):
+        model = self.models['read_config']
+        nbins = len(self.models['histogram'].bin_fields)
+        config = {}
+        for f in model.fields:
+            # integer diameters and weightings are in 1/100 units
+            scale = 100 if model.formats[f] == 'H' else 1
+            if f.startswith('BBD'):
+                # log spaced bin boundaries, 0.35 to 40 um
+                d = scale * 0.35 * (40. / 0.35) ** (int(f[3:]) / nbins)
+                config[f] = int(round(d)) if scale == 100 else d
+            elif f.startswith('BB'):
+                config[f] = 10 * int(f[2:])
+            elif f.startswith('BW'):
+                config[f] = scale
+            else:
+                config[f] = 0
+        for f, d in (('M_A', 1.), ('M_B', 2.5), ('M_C', 10.)):
+            config[f] = int(d * 100) if model.formats[f] == 'H' else d
+        config['MaxTOF'] = 2048
+        return config
+
+    def _checksummed(self, model, values):
+        raw = bytearray(model.pack(values))
+        if model.has_checksum:
+            if self.kind == 'N2':
+                bins = sum(values[model.index[f]] for f in model.bin_fields)
+                values[model.index['Checksum']] = bins & 0xFFFF
+                raw = bytearray(model.pack(values))
+            else:
+                raw[-2:] = struct.pack('<H', _crc16(raw[:-2]))
+        if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+            raw[self.random.randrange(len(raw))] ^= 0xFF
+        return list(raw)
+
+    def _pm(self, bins):
+        pm1 = 0.01 * sum(bins[:3])
+        pm25 = pm1 + 0.02 * sum(bins[3:8])
+        pm10 = pm25 + 0.05 * sum(bins[8:])
+        return {'PM1': pm1, 'PM2.5': pm25, 'PM10': pm10}
+
+    def histogram_values(self):
+        """Generate a plausible set of histogram values"""
+        model = self.models['histogram']
+        fmt = model.formats
+        rnd = self.random
+        active = self.fan and self.laser
+        hist = {}
+        for f in model.fields:
+            if 'Bin ' in f:
+                hist[f] = rnd.randrange(0, 200) if active else 0
+            elif 'MToF' in f:
+                hist[f] = rnd.randrange(0, 40) if active else 0
+            elif f == 'Sampling Period':
+                hist[f] = 100 if fmt[f] == 'H' else 1.
+            elif f == 'SFR':
+                hist[f] = rnd.randrange(500, 560) if fmt[f] == 'H' else rnd.uniform(5., 5.6)
+            elif f == 'Temperature':
+                # 25 °C, N2 reports 10000 when the sensor is missing
+                hist[f] = 10000 if fmt[f] == 'L' else int((25. + 45.) / 175. * 65535)
+            elif f == 'Relative humidity':
+                hist[f] = int(0.4 * 65535)
+            elif f == 'Laser status':
+                hist[f] = 600 if self.laser else 0
+            else:
+                hist[f] = 0
+        bins = [hist[f] for f in model.bin_fields]
+        hist.update(self._pm(bins))
+        return hist
+
+    def _reply(self, cmd):
+        """Data returned after a read command handshake"""
+        if cmd == _OPC_CMD_READ_HISTOGRAM:
+            model = self.models['histogram']
+            hist = self.histogram_values()
+            return self._checksummed(model, [hist[f] for f in model.fields])
+        if cmd == _OPC_CMD_READ_PM:
+            model = self.models['pm']
+            if self.kind == 'R2' and self.fwversion < (2, 82):
+                # READ_PM is broken on old R2 firmwares
+                return [0xFF] * model.size
+            values = self._pm([self.random.randrange(0, 200) for i in range(24)])
+            return self._checksummed(model, [values.get(f, 0) for f in model.fields])
+        if cmd == _OPC_CMD_READ_INFO_STRING:
+            return list(self.params['info'].ljust(60).encode()[:60])
+        if cmd == _OPC_CMD_READ_SERIAL_STRING:
+            return list(self.serial.ljust(60).encode()[:60])
+        if cmd == _OPC_CMD_READ_FW_VERSION:
+            return list(self.fwversion)
+        if cmd == _OPC_CMD_READ_POWER_STATE and 'popt' in self.models:
+            model = self.models['popt']
+            state = {'FanON': int(self.fan), 'LaserON': int(self.laser), 'FanDACVal': 255,
+                     'LaserDACVal': 140, 'LaserSwitch': int(self.laser), 'GainToggle': 3}
+            return list(model.pack([state[f] for f in model.fields]))
+        if cmd == _OPC_CMD_READ_CONFIG and self.config is not None:
+            model = self.models['read_config']
+            return list(model.pack([self.config[f] for f in model.fields]))
+        return []
+
+    def _write_size(self, cmd):
+        if cmd == _OPC_CMD_WRITE_CONFIG and 'write_config' in self.models:
+            return self.models['write_config'].size
+        return _WRITE_SIZES.get(cmd, 0)
+
+    def _written(self, cmd, buf):
+        """Apply a completed write command"""
+        if cmd == _OPC_CMD_WRITE_CONFIG:
+            model = self.models['write_config']
+            self.config.update(model.unpack(bytes(buf)))
+        elif cmd == _OPC_CMD_WRITE_POWER_STATE:
+            b = buf[0]
+            if self.kind == 'N3':
+                flag, on = b >> 1, bool(b & 1)
+                if flag == _OPC_N3_POPT_FAN_POT:
+                    self.fan = on
+                elif flag == _OPC_N3_POPT_LASER_SWITCH:
+                    self.laser = on
+            elif self.kind == 'N2':
+                self.fan = self.laser = (b == 0x00)
+            else:
+                self.fan = self.laser = (b == 0x03)
+
+    def _handshake(self, b):
+        """Handle a command byte, returns the handshake response"""
+        if self.unexpected_rate and self.random.random() < self.unexpected_rate:
+            self._cmd = None
+            return 0x00
+        if b != self._cmd:
+            self._cmd = b
+            self._polls = 0
+            self.commands[b] = self.commands.get(b, 0) + 1
+        if self.params['busy'] and self._polls < self.busy_polls:
+            self._polls += 1
+            return _OPC_BUSY
+
+        # ready, prepare data transfer
+        self._cmd = None
+        if b == _OPC_CMD_RESET:
+            self.fan = self.laser = False
+            self.config = self._default_config() if self.config is not None else None
+        self._tx = self._reply(b)[::-1]
+        self._rx = self._write_size(b)
+        self._rx_cmd = b
+        self._rx_buf = []
+        return _OPC_READY
+
+    def _byte(self, b):
+        if self._tx:
+            return self._tx.pop()
+        if self._rx:
+            self._rx_buf.append(b)
+            self._rx -= 1
+            if not self._rx:
+                self._written(self._rx_cmd, self._rx_buf)
+            return 0x00
+        return self._handshake(b)
+
+    def xfer(self, data, speed_hz=0, delay_usecs=0, bits_per_word=8):
+        """Transfer a list of bytes, returns the bytes read back"""
+        self.transfers += 1
+        if self.latency:
+            sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self._cmd = None
+            self._tx = []
+            self._rx = 0
+            raise USBISSError('Simulated USB-SPI error')
+        return [self._byte(b) for b in data]
+
+    xfer2 = xfer
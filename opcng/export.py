@@ -0,0 +1,199 @@
+"""Columnar export of OPC samples.
+
+Raw frames, e.g. from :meth:`opcng._OPC.stream` with ``raw=True`` or
+from a :class:`opcng.record.Recording`, are collected in a fixed size
+preallocated batch and written column-wise, one batch at a time, so
+memory use doesn't depend on run length. Column order and dtypes come
+from the device data models, preceded by a float64 'timestamp' column.
+
+Supported formats, chosen from the file extension:
+
+- ``.npy``: a single NumPy structured array, e.g. to be loaded with
+  ``numpy.load(path, mmap_mode='r')``. Requires numpy.
+- ``.parquet``: Parquet file, one row group per batch. Requires pyarrow.
+- ``.arrow``: Arrow IPC file, one record batch per batch. Requires pyarrow.
+
+:Example:
+
+>>> from opcng.export import ColumnExporter
+>>> with ColumnExporter('n3.parquet', dev._histogram_model, dev=dev) as exp:
+...     for timestamp, raw in dev.stream(period=1., raw=True, count=86400):
+...         exp.append(timestamp, raw)
+"""
+import os
+import struct
+from array import array
+
+from . import np
+from .record import _MODEL_IDS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+_FORMATS = {'.npy': 'npy', '.parquet': 'parquet', '.arrow': 'arrow'}
+
+_NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# room left in the .npy header for the final number of rows
+_NPY_SHAPE_RESERVE = 24
+
+
+def _npy_header(dtype, n, length=None):
+    """Format a .npy v1.0 header, padded to ``length`` bytes"""
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+        np.lib.format.dtype_to_descr(dtype), n)
+    if length is None:
+        length = len(_NPY_MAGIC) + 2 + len(header) + _NPY_SHAPE_RESERVE + 1
+        length += -length % 64
+    header = header.ljust(length - len(_NPY_MAGIC) - 2 - 1) + '\n'
+    return _NPY_MAGIC + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class ColumnExporter(object):
+    """Write raw frames column-wise in fixed size batches.
+
+    :param path: output file, format chosen from its extension
+    :param model: data model of the frames, e.g. ``dev._histogram_model``
+    :param batch_size: number of frames per batch
+    :param dev: if given and model is its histogram model, histograms
+                are post processed with
+                :meth:`opcng._OPC.histogram_batch` and exported as
+                float64 columns instead of raw model dtypes. Other
+                models are exported as is
+    :param format: 'npy', 'parquet' or 'arrow' (default: from path extension)
+    """
+    def __init__(self, path, model, batch_size=4096, dev=None, format=None):
+        if np is None:
+            raise ImportError('numpy is required for columnar export')
+        self.format = format or _FORMATS.get(os.path.splitext(path)[1])
+        if self.format not in _FORMATS.values():
+            raise ValueError('Unsupported export format: {}'.format(path))
+        if self.format != 'npy' and pa is None:
+            raise ImportError('pyarrow is required for {} export'.format(self.format))
+
+        self.path = path
+        self.model = model
+        self.batch_size = batch_size
+        self.dev = dev
+        # only histograms have post processing
+        self._post_process = dev is not None and model is dev._histogram_model
+        self.count = 0
+
+        # preallocated batch
+        self._frames = bytearray(batch_size * model.size)
+        self._timestamps = array('d', bytes(8 * batch_size))
+        self._n = 0
+
+        if self._post_process:
+            fields = [(f, np.float64) for f in model.fields]
+        else:
+            fields = [(f, model.dtype[f]) for f in model.fields]
+        self.dtype = np.dtype([('timestamp', '<f8')] + fields)
+
+        self._writer = None
+        self._file = None
+        if self.format == 'npy':
+            self._file = open(path, 'wb')
+            self._header = _npy_header(self.dtype, 0)
+            self._file.write(self._header)
+        else:
+            self.schema = pa.schema([(name, pa.from_numpy_dtype(self.dtype[name]))
+                                     for name in self.dtype.names])
+            if self.format == 'parquet':
+                self._writer = pq.ParquetWriter(path, self.schema)
+            else:
+                self._file = pa.OSFile(path, 'wb')
+                self._writer = pa.ipc.new_file(self._file, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, timestamp, raw_bytes):
+        """Add a raw frame.
+
+        :param timestamp: frame timestamp
+        :param raw_bytes: the raw frame, exactly one model size long
+        """
+        sz = self.model.size
+        if len(raw_bytes) != sz:
+            raise ValueError('Expected a {} bytes frame for {}, got {} bytes'.format(
+                sz, self.model.name, len(raw_bytes)))
+        self._frames[self._n * sz:(self._n + 1) * sz] = raw_bytes
+        self._timestamps[self._n] = timestamp
+        self._n += 1
+        if self._n == self.batch_size:
+            self.flush()
+
+    def extend(self, frames):
+        """Add many (timestamp, raw_bytes) pairs"""
+        for timestamp, raw_bytes in frames:
+            self.append(timestamp, raw_bytes)
+
+    def _batch(self):
+        n = self._n
+        raw = memoryview(self._frames)[:n * self.model.size]
+        if self._post_process:
+            data = self.dev.histogram_batch(raw, check=False)
+        else:
+            data = self.model.unpack_array(raw)
+
+        batch = np.empty(n, dtype=self.dtype)
+        batch['timestamp'] = np.frombuffer(self._timestamps, dtype=np.float64, count=n)
+        for f in self.model.fields:
+            batch[f] = data[f]
+        return batch
+
+    def flush(self):
+        """Write pending frames as a batch"""
+        if not self._n:
+            return
+        batch = self._batch()
+
+        if self.format == 'npy':
+            self._file.write(batch.tobytes())
+        else:
+            arrays = [pa.array(np.ascontiguousarray(batch[name])) for name in self.dtype.names]
+            if self.format == 'parquet':
+                self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+            else:
+                self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+        self.count += self._n
+        self._n = 0
+
+    def close(self):
+        """Write pending frames and finalize the file"""
+        self.flush()
+        if self.format == 'npy':
+            # now we know the final shape
+            self._file.seek(0)
+            self._file.write(_npy_header(self.dtype, self.count, len(self._header)))
+            self._file.close()
+        else:
+            self._writer.close()
+            if self._file is not None:
+                self._file.close()
+
+
+def export_recording(recording, path, model, serial=None, start=None, end=None, **kwargs):
+    """Export frames from a :class:`opcng.record.Recording`.
+
+    :param recording: an open recording
+    :param path: output file, format chosen from its extension
+    :param model: model name, e.g. 'OPCN3Histogram'
+    :param serial: only export frames of this device serial
+    :param start: only frames with timestamp >= start
+    :param end: only frames with timestamp < end
+    :param kwargs: see :class:`ColumnExporter`
+
+    :returns: number of exported frames
+    """
+    with ColumnExporter(path, recording.model(_MODEL_IDS[model]), **kwargs) as exp:
+        for timestamp, _, _, frame in recording.frames(start, end, serial, model):
+            exp.append(timestamp, frame)
+    return exp.count
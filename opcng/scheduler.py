@@ -0,0 +1,197 @@
+"""Poll many OPC devices at fixed sampling periods.
+
+Devices on separate buses are polled in parallel, one thread per bus,
+while devices sharing a bus are polled one at a time from the same
+thread. Each device keeps its own sampling period, deadlines are
+computed from the start time so there's no drift.
+
+:Example:
+
+>>> from opcng.scheduler import Scheduler
+>>> s = Scheduler()
+>>> s.add(dev0, 1.0, print, bus=0)
+>>> s.add(dev1, 1.0, print, bus=0)   # same bus as dev0, chip-select 1
+>>> s.add(dev2, 10.0, print, bus=1)
+>>> s.start()
+"""
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PollStats(object):
+    """Per-device polling statistics.
+
+    :ivar samples: number of successful polls
+    :ivar errors: number of polls raising an exception or returning None
+    :ivar missed: number of skipped deadlines, e.g. because the bus
+                  was busy with other devices
+    :ivar skipped: number of polls skipped while the device was
+                   quarantined or its circuit breaker open, see
+                   :class:`opcng.RecoveryPolicy`
+    :ivar callback_errors: number of samples whose callback raised an
+                           exception
+    :ivar lag: delay between the last deadline and the actual poll (s)
+    :ivar max_lag: maximum lag so far (s)
+    """
+    __slots__ = ('samples', 'errors', 'missed', 'skipped', 'callback_errors', 'lag', 'max_lag')
+
+    def __init__(self):
+        self.samples = 0
+        self.errors = 0
+        self.missed = 0
+        self.skipped = 0
+        self.callback_errors = 0
+        self.lag = 0.
+        self.max_lag = 0.
+
+    def __repr__(self):
+        return ('PollStats(samples={}, errors={}, missed={}, skipped={}, callback_errors={}, '
+                'lag={:.6f}, max_lag={:.6f})'
+                .format(self.samples, self.errors, self.missed, self.skipped,
+                        self.callback_errors, self.lag, self.max_lag))
+
+
+class _Task(object):
+    """A device polled periodically"""
+    def __init__(self, dev, period, callback, method, kwargs):
+        self.dev = dev
+        self.period = period
+        self.callback = callback
+        self.method = method
+        self.kwargs = kwargs
+        self.stats = PollStats()
+        self.start = None
+        self.count = 0
+
+    def deadline(self):
+        return self.start + self.count * self.period
+
+
+class Scheduler(object):
+    """Poll several devices, each one at its own period.
+
+    :param clock: monotonic clock function (default: time.monotonic)
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._buses = {}
+        self._threads = []
+        self._stop = threading.Event()
+
+    def add(self, dev, period, callback, bus=None, method='histogram', **kwargs):
+        """Add a device to the scheduler.
+
+        :param dev: an OPC device instance
+        :param period: sampling period in seconds
+        :param callback: called as ``callback(dev, sample, timestamp)``
+                         for each sample, with timestamp from time.time()
+        :param bus: a hashable key identifying the physical bus. Devices
+                    with the same key are never polled concurrently
+                    (default: the device SPI object)
+        :param method: name of the device method to poll (default: histogram)
+        :param kwargs: extra arguments for the polled method
+        """
+        if bus is None:
+            bus = id(dev.spi)
+        task = _Task(dev, period, callback, method, kwargs)
+        self._buses.setdefault(bus, []).append(task)
+        return task.stats
+
+    @property
+    def stats(self):
+        """Dictionary of :class:`PollStats` keyed by device"""
+        return {task.dev: task.stats for tasks in self._buses.values() for task in tasks}
+
+    def _poll(self, task):
+        now = self.clock()
+        deadline = task.deadline()
+        lag = now - deadline
+
+        # skip deadlines we are late for by more than a period
+        if lag >= task.period:
+            skipped = int(lag // task.period)
+            task.count += skipped
+            task.stats.missed += skipped
+            lag -= skipped * task.period
+
+        task.stats.lag = lag
+        task.stats.max_lag = max(task.stats.max_lag, lag)
+
+        # don't even try while a failing device recovers
+        breaker = getattr(task.dev, 'breaker', None)
+        if breaker is not None and not breaker.available():
+            task.stats.skipped += 1
+            task.count += 1
+            return
+
+        timestamp = time.time()
+        try:
+            sample = getattr(task.dev, task.method)(**task.kwargs)
+        except Exception as e:
+            logger.error('Error polling {}: {}'.format(task.dev, e))
+            sample = None
+
+        if sample is None:
+            task.stats.errors += 1
+        else:
+            task.stats.samples += 1
+            # a failing callback must not stop the bus thread
+            try:
+                task.callback(task.dev, sample, timestamp)
+            except Exception as e:
+                logger.exception('Error in callback for {}: {}'.format(task.dev, e))
+                task.stats.callback_errors += 1
+
+        task.count += 1
+
+    def _run_bus(self, tasks):
+        start = self.clock()
+        queue = []
+        for i, task in enumerate(tasks):
+            task.start = start
+            task.count = 0
+            queue.append((task.deadline(), i, task))
+        heapq.heapify(queue)
+
+        while not self._stop.is_set():
+            deadline, i, task = queue[0]
+            timeout = deadline - self.clock()
+            if timeout > 0:
+                if self._stop.wait(timeout):
+                    break
+            self._poll(task)
+            heapq.heapreplace(queue, (task.deadline(), i, task))
+
+    def start(self):
+        """Start polling, one thread per bus. Does nothing if already
+        running."""
+        if any(t.is_alive() for t in self._threads):
+            return
+        self._stop.clear()
+        self._threads = []
+        for bus, tasks in self._buses.items():
+            t = threading.Thread(target=self._run_bus, args=(tasks,),
+                                 name='opcng-bus-{}'.format(bus), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        """Stop polling and wait for running polls to complete."""
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def run(self, duration=None):
+        """Start polling, as :meth:`start`, and block the calling thread
+        until :meth:`stop` is called from another thread, or for
+        ``duration`` seconds. Polling is stopped on return."""
+        self.start()
+        try:
+            self._stop.wait(duration)
+        finally:
+            self.stop()
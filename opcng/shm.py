@@ -0,0 +1,285 @@
+"""Share acquired samples between processes.
+
+Only one process may own the SPI bus. A :class:`Publisher`, fed by the
+process polling the devices, writes decoded samples into a ring of
+slots in a shared memory block; any number of :class:`Subscriber`
+processes attach to it by name and read samples without touching the
+bus and without locks.
+
+Shared memory layout (little endian):
+
+- a 64 bytes header: magic ``b'OPCS'``, layout version, header size,
+  slot size, capacity, name of the device data model (e.g.
+  'OPCN3Histogram', see :data:`opcng._MODEL_REGISTRY`) and the number
+  of samples published so far.
+- ``capacity`` slots laid out as :func:`sample_model`: a sequence lock,
+  the sample number, its timestamp and one float64 per data model
+  field, post processed. Fields missing from a sample (e.g. a partial
+  histogram) are NaN.
+
+Each slot is guarded by a sequence lock: the publisher makes it odd
+while writing and even when done, readers retry if it's odd or changed
+while copying. Readers falling more than ``capacity`` samples behind
+lose the oldest ones.
+
+:Example:
+
+>>> # acquisition process
+>>> from opcng.shm import Publisher
+>>> pub = Publisher('opc-n3-0', dev._histogram_model, capacity=3600)
+>>> for timestamp, hist in dev.stream(period=1.):
+...     pub.publish(timestamp, hist)
+
+>>> # any other process
+>>> from opcng.shm import Subscriber
+>>> sub = Subscriber('opc-n3-0')
+>>> for number, timestamp, hist in sub.follow():
+...     print(timestamp, hist['PM2.5'])
+"""
+import logging
+import math
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from time import sleep
+
+from . import _MODEL_REGISTRY, _data_model, np
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'OPCS'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHHII32s')
+_HEADER_SIZE = 64
+# number of published samples, right after the header fields
+_COUNT = struct.Struct('<Q')
+_COUNT_OFFSET = _HEADER.size
+_LOCK = struct.Struct('<Q')
+
+# slot fields preceding the sample values
+_SLOT_PREFIX = [['_lock', 'Q'], ['_number', 'Q'], ['timestamp', 'd']]
+
+_sample_models = {}
+
+# blocks created by publishers in this process (or its parent, if
+# forked), registered with the resource tracker, see _attach()
+_published = set()
+
+
+def sample_model(model):
+    """Data model of a shared memory slot holding a sample of model:
+    sequence lock, sample number, timestamp and the model fields (but
+    the checksum) as float64."""
+    slot = _sample_models.get(model.name)
+    if slot is None:
+        fields = [[f, 'd'] for f in model.fields if f != 'Checksum']
+        slot = _sample_models[model.name] = _data_model(_SLOT_PREFIX + fields,
+                                                        model.name + 'Sample')
+    return slot
+
+
+class Publisher(object):
+    """Publish samples in a shared memory ring.
+
+    Instances can be used as :class:`opcng.scheduler.Scheduler`
+    callbacks.
+
+    :param name: shared memory block name, readers attach with it
+    :param model: data model of the samples, e.g. ``dev._histogram_model``
+    :param capacity: number of samples kept
+    """
+    def __init__(self, name, model, capacity=3600):
+        if _MODEL_REGISTRY.get(model.name) is not model:
+            raise ValueError('Only registry data models can be shared: {}'.format(model.name))
+        self.name = name
+        self.model = model
+        self.capacity = capacity
+        self.slot = sample_model(model)
+        self.fields = self.slot.fields[len(_SLOT_PREFIX):]
+        self.count = 0
+
+        self.shm = shared_memory.SharedMemory(name, create=True,
+                                              size=_HEADER_SIZE + capacity * self.slot.size)
+        _published.add(self.shm._name)
+        buf = self.shm.buf
+        buf[:_HEADER_SIZE] = bytes(_HEADER_SIZE)
+        _HEADER.pack_into(buf, 0, _MAGIC, _VERSION, _HEADER_SIZE, self.slot.size,
+                          capacity, model.name.encode())
+        buf[_HEADER_SIZE:] = bytes(capacity * self.slot.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def publish(self, timestamp, sample):
+        """Write a sample, overwriting the oldest one if the ring is full.
+
+        :param timestamp: sample time in seconds
+        :param sample: a dictionary, e.g. from :meth:`opcng._OPC.histogram`
+
+        :returns: the sample number
+        """
+        if sample is None:
+            return None
+        values = []
+        for f in self.fields:
+            v = sample.get(f)
+            values.append(math.nan if v is None else v)
+
+        buf = self.shm.buf
+        n = self.count
+        offset = _HEADER_SIZE + (n % self.capacity) * self.slot.size
+        lock = _LOCK.unpack_from(buf, offset)[0]
+        _LOCK.pack_into(buf, offset, lock + 1)
+        self.slot.struct.pack_into(buf, offset, lock + 1, n, timestamp, *values)
+        _LOCK.pack_into(buf, offset, lock + 2)
+
+        self.count = n + 1
+        _COUNT.pack_into(buf, _COUNT_OFFSET, self.count)
+        return n
+
+    def __call__(self, dev, sample, timestamp):
+        """Scheduler callback, see :meth:`opcng.scheduler.Scheduler.add`"""
+        self.publish(timestamp, sample)
+
+    def close(self):
+        """Release and remove the shared memory block. Attached readers
+        keep their mapping."""
+        self.shm.close()
+        self.shm.unlink()
+        _published.discard(self.shm._name)
+
+
+def _attach(name):
+    """Attach an existing shared memory block without letting the
+    resource tracker remove it when this process exits"""
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Python < 3.13. Blocks of a publisher sharing our resource
+        # tracker (same process or forked) are registered once: leave
+        # the registration to the publisher unlinking them
+        shm = shared_memory.SharedMemory(name)
+        if shm._name not in _published:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class Subscriber(object):
+    """Read samples from a :class:`Publisher` in another process.
+
+    :param name: shared memory block name
+    :param retries: attempts to read a slot being written before giving up
+    """
+    def __init__(self, name, retries=100):
+        self.name = name
+        self.retries = retries
+        self.shm = _attach(name)
+        magic, version, header_size, slot_size, capacity, model_name = \
+            _HEADER.unpack_from(self.shm.buf, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self.shm.close()
+            raise ValueError('{} is not an OPC sample ring'.format(name))
+        self.model = _MODEL_REGISTRY[model_name.rstrip(b'\0').decode()]
+        self.slot = sample_model(self.model)
+        if slot_size != self.slot.size:
+            self.shm.close()
+            raise ValueError('Slot size mismatch for {}'.format(self.model.name))
+        self.capacity = capacity
+        self.fields = self.slot.fields[len(_SLOT_PREFIX):]
+        # number of samples lost by falling behind, see poll()
+        self.lost = 0
+        self.cursor = self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def count(self):
+        """Number of samples published so far"""
+        return _COUNT.unpack_from(self.shm.buf, _COUNT_OFFSET)[0]
+
+    def _offset(self, number):
+        return _HEADER_SIZE + (number % self.capacity) * self.slot.size
+
+    def read(self, number):
+        """Read a sample by number.
+
+        :returns: a (timestamp, sample) pair, None if the sample was not
+                  published yet or was already overwritten
+        """
+        buf = self.shm.buf
+        offset = self._offset(number)
+        for i in range(self.retries):
+            values = self.slot.struct.unpack_from(buf, offset)
+            lock = values[0]
+            if lock & 1 or _LOCK.unpack_from(buf, offset)[0] != lock:
+                # being written
+                continue
+            if values[1] != number or not lock:
+                return None
+            return values[2], dict(zip(self.fields, values[3:]))
+        logger.warning('Could not read sample {} from {}'.format(number, self.name))
+        return None
+
+    def latest(self):
+        """Read the last published sample, see :meth:`read`"""
+        count = self.count
+        return self.read(count - 1) if count else None
+
+    def poll(self):
+        """Read samples published since the last call (or since
+        attaching). Samples already overwritten are counted in
+        :attr:`lost`.
+
+        :returns: a list of (number, timestamp, sample) tuples
+        """
+        count = self.count
+        if count - self.cursor > self.capacity:
+            self.lost += count - self.capacity - self.cursor
+            self.cursor = count - self.capacity
+        samples = []
+        for number in range(self.cursor, count):
+            item = self.read(number)
+            if item is None:
+                self.lost += 1
+            else:
+                samples.append((number,) + item)
+        self.cursor = count
+        return samples
+
+    def follow(self, interval=0.1, stop=None):
+        """Yield new samples as they are published, polling every
+        interval seconds.
+
+        :param interval: polling interval in seconds
+        :param stop: a threading.Event ending the iteration
+
+        :returns: a generator of (number, timestamp, sample) tuples
+        """
+        while stop is None or not stop.is_set():
+            samples = self.poll()
+            yield from samples
+            if not samples:
+                sleep(interval)
+
+    def array(self):
+        """Zero-copy structured array view of the slots, see
+        :func:`sample_model`. Slots may change while being read, check
+        ``_lock`` is even and unchanged for consistent values. Requires
+        numpy.
+
+        Release the view before :meth:`close`.
+        """
+        if np is None:
+            raise ImportError('numpy is required for array views')
+        return np.ndarray(self.capacity, dtype=self.slot.dtype, buffer=self.shm.buf,
+                          offset=_HEADER_SIZE)
+
+    def close(self):
+        """Detach from the shared memory block"""
+        self.shm.close()
@@ -0,0 +1,64 @@
+"""Rolling statistics"""
+import math
+import statistics
+
+import pytest
+
+from opcng.aggregate import Aggregator, RollingWindow
+
+
+def test_window_stats():
+    w = RollingWindow(60, ['x'], buckets=6)
+    values = [3., 1., 4., 1., 5., 9., 2., 6.]
+    for i, x in enumerate(values):
+        w.add(100. + i * 5, {'x': x, 'other': 'ignored'})
+    s = w.stats(135.)['x']
+    assert s.count == len(values)
+    assert s.mean == pytest.approx(statistics.mean(values))
+    assert s.variance == pytest.approx(statistics.variance(values))
+    assert (s.min, s.max) == (1., 9.)
+
+
+def test_window_expires():
+    w = RollingWindow(60, ['x'], buckets=6)
+    w.add(0., {'x': 1.})
+    w.add(59., {'x': 3.})
+    assert w.stats(59.)['x'].count == 2
+    # the first bucket [0, 10) left the window
+    assert w.stats(60.)['x'].count == 1
+    assert math.isnan(w.stats(200.)['x'].mean)
+
+
+def test_late_samples():
+    w = RollingWindow(60, ['x'], buckets=60)
+    w.add(100.5, {'x': 1.})
+    w.add(101.5, {'x': 2.})
+    # late, within the window
+    assert w.add(100.7, {'x': 3.})
+    assert w.add(42.5, {'x': 10.})
+    s = w.stats(101.5)['x']
+    assert s.count == 4 and s.max == 10.
+    # older than the window
+    assert not w.add(41.5, {'x': 100.})
+    # a newer sample reuses the slot of bucket 101, a late one can't
+    # reset it back
+    w.add(161.5, {'x': 5.})
+    assert not w.add(101.2, {'x': 7.})
+    s = w.stats(161.5)['x']
+    assert s.count == 1 and s.mean == 5.
+
+
+def test_aggregator():
+    agg = Aggregator(windows=(10, 60), buckets=10, fields=['PM1', 'PM10'])
+    for t in range(60):
+        agg('a', {'PM1': 1., 'PM10': float(t)}, t)
+        agg('b', {'PM1': 2., 'PM10': None}, t)
+    agg('c', None, 0)
+    assert agg.devices == ['a', 'b']
+    assert agg.means(10, 'PM1') == {'a': 1., 'b': 2.}
+    assert agg.stats(60, 'a')['PM10'].mean == pytest.approx(29.5)
+    assert agg.stats(10, 'a')['PM10'].count == 10
+    assert agg.stats(10, 'b')['PM10'].count == 0
+    rows = agg.aligned(10, 'PM1')
+    assert len(rows) == 10
+    assert all(means == {'a': 1., 'b': 2.} for t, means in rows)
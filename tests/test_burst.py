@@ -0,0 +1,46 @@
+"""Burst transfers and their fallback"""
+import opcng
+from opcng.emulator import SimulatedSPI
+
+
+def _device(spi, **kwargs):
+    return opcng.OPCN3(spi, burst=True, wait_policy=opcng.FAST_WAIT_POLICY,
+                       metrics=opcng.Metrics(), **kwargs)
+
+
+def test_burst_read():
+    dev = _device(SimulatedSPI('N3', busy_polls=0, seed=1))
+    assert dev.histogram() is not None
+    assert dev.burst
+    assert dev.metrics.transfers < dev._histogram_model.size
+
+
+def test_single_failure_keeps_burst():
+    spi = SimulatedSPI('N3', busy_polls=0, seed=1, corrupt_rate=1.)
+    dev = _device(spi)
+    for i in range(2):
+        assert dev.histogram() is None
+    spi.corrupt_rate = 0.
+    assert dev.histogram() is not None
+    spi.corrupt_rate = 1.
+    for i in range(2):
+        assert dev.histogram() is None
+    assert dev.burst
+    assert dev.metrics.events['burst_fallback'] == 0
+
+
+def test_fallback_after_consecutive_failures():
+    dev = _device(SimulatedSPI('N3', busy_polls=0, seed=1, corrupt_rate=1.))
+    for i in range(3):
+        dev.histogram()
+    assert not dev.burst
+    assert dev.metrics.events['burst_fallback'] == 1
+    assert dev.metrics.events['checksum_failure'] == 3
+
+
+def test_fallback_disabled():
+    dev = _device(SimulatedSPI('N3', busy_polls=0, seed=1, corrupt_rate=1.),
+                  burst_fallback=None)
+    for i in range(10):
+        dev.histogram()
+    assert dev.burst
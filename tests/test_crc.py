@@ -0,0 +1,71 @@
+"""Cross-check the CRC-16 implementations against the bitwise reference"""
+import random
+import struct
+
+import pytest
+
+import opcng
+from opcng import _crc16, _crc16_bitwise, _crc16_frames
+
+# frame payload sizes, including edge cases
+SIZES = [0, 1, 2, 3, 7, 8, 63, 64, 65, 84, 256]
+
+
+@pytest.fixture(params=['numpy', 'pure'])
+def numpy_mode(request, monkeypatch):
+    """Run with and without numpy"""
+    if request.param == 'numpy':
+        if opcng.np is None:
+            pytest.skip('numpy not installed')
+    else:
+        monkeypatch.setattr(opcng, 'np', None)
+    return request.param
+
+
+def _frame(rnd, n, valid=True):
+    payload = bytes(rnd.randrange(256) for i in range(n))
+    crc = _crc16_bitwise(payload)
+    if not valid:
+        crc ^= 1 << rnd.randrange(16)
+    return payload + struct.pack('<H', crc)
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_crc16_matches_reference(n):
+    rnd = random.Random(n)
+    for i in range(20):
+        buf = bytes(rnd.randrange(256) for j in range(n))
+        assert _crc16(buf) == _crc16_bitwise(buf)
+        assert _crc16(bytearray(buf)) == _crc16_bitwise(list(buf))
+
+
+def test_crc16_edge_values():
+    for buf in (b'', b'\x00' * 64, b'\xff' * 64, bytes(range(256))):
+        assert _crc16(buf) == _crc16_bitwise(buf)
+    assert _crc16(b'') == opcng._CRC16_INIT
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_crc16_frames_matches_reference(numpy_mode, n):
+    rnd = random.Random(1000 + n)
+    frames = [_frame(rnd, n) for i in range(17)]
+    expected = [(_crc16_bitwise(f[:-2]), struct.unpack('<H', f[-2:])[0]) for f in frames]
+    assert _crc16_frames(frames, n + 2) == expected
+    assert _crc16_frames(b''.join(frames), n + 2) == expected
+    assert _crc16_frames(memoryview(b''.join(frames)), n + 2) == expected
+
+
+def test_crc16_frames_size_mismatch(numpy_mode):
+    with pytest.raises(ValueError):
+        _crc16_frames(b'\x00' * 10, 4)
+
+
+@pytest.mark.parametrize('cls', [opcng.OPCN3, opcng.OPCR1])
+def test_verify_checksums(numpy_mode, cls):
+    model = cls._histogram_model
+    rnd = random.Random(model.size)
+    valid = [rnd.random() < 0.7 for i in range(50)]
+    frames = [_frame(rnd, model.size - 2, v) for v in valid]
+    dev = cls(None)
+    assert dev.verify_checksums(frames) == valid
+    assert dev.verify_checksums(b''.join(frames)) == valid
@@ -0,0 +1,52 @@
+"""Columnar export"""
+import pytest
+
+import opcng
+from opcng.emulator import SimulatedSPI
+
+np = pytest.importorskip('numpy')
+from opcng.export import ColumnExporter  # noqa: E402
+
+
+@pytest.fixture
+def dev():
+    spi = SimulatedSPI('N3', busy_polls=0, seed=1)
+    return opcng.OPCN3(spi, wait_policy=opcng.FAST_WAIT_POLICY)
+
+
+def _frames(dev, n):
+    return [(float(i), dev._read_histogram_frame()) for i in range(n)]
+
+
+def test_npy_round_trip(tmp_path, dev):
+    path = str(tmp_path / 'h.npy')
+    frames = _frames(dev, 10)
+    with ColumnExporter(path, dev._histogram_model, batch_size=4) as exp:
+        exp.extend(frames)
+    data = np.load(path)
+    assert list(data['timestamp']) == [t for t, f in frames]
+    expected = dev._histogram_model.unpack_array(b''.join(f for t, f in frames))
+    assert (data['Bin 0'] == expected['Bin 0']).all()
+
+
+def test_post_processed(tmp_path, dev):
+    path = str(tmp_path / 'h.npy')
+    frames = _frames(dev, 3)
+    with ColumnExporter(path, dev._histogram_model, dev=dev) as exp:
+        exp.extend(frames)
+    data = np.load(path)
+    assert data['PM2.5'].dtype == np.float64
+    assert data['SFR'][0] == pytest.approx(dev.histogram_batch(frames[0][1])['SFR'][0])
+
+
+def test_wrong_frame_size(tmp_path, dev):
+    path = str(tmp_path / 'h.npy')
+    frames = _frames(dev, 3)
+    with ColumnExporter(path, dev._histogram_model) as exp:
+        exp.append(*frames[0])
+        with pytest.raises(ValueError):
+            exp.append(1., frames[1][1][:-1])
+        exp.append(*frames[2])
+    data = np.load(path)
+    assert len(data) == 2
+    assert data['Checksum'][1] == dev._histogram_model.unpack(frames[2][1])['Checksum']
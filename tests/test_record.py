@@ -0,0 +1,100 @@
+"""Recorder file format round trips on the emulator"""
+import os
+
+import pytest
+
+import opcng
+from opcng.emulator import SimulatedSPI
+from opcng.record import Recorder, Recording
+
+
+@pytest.fixture
+def dev():
+    return opcng.OPCN3(SimulatedSPI('N3', serial='OPC-N3 123'))
+
+
+def _record(path, dev, n, **kwargs):
+    with Recorder(path, **kwargs) as rec:
+        rec.attach(dev)
+        for i in range(n):
+            assert dev.histogram() is not None
+        rec.detach(dev)
+
+
+def test_round_trip(tmp_path, dev):
+    path = str(tmp_path / 'a.rec')
+    _record(path, dev, 10, chunk_size=4)
+    with Recording(path) as r:
+        assert len(r) == 10
+        assert [c.count for c in r.chunks] == [4, 4, 2]
+        samples = list(r.samples())
+    assert [s for t, s, h in samples] == ['OPC-N3 123'] * 10
+    timestamps = [t for t, s, h in samples]
+    assert timestamps == sorted(timestamps)
+
+
+def test_reopen_appends(tmp_path, dev):
+    path = str(tmp_path / 'a.rec')
+    _record(path, dev, 10)
+    _record(path, dev, 20)
+    with Recording(path) as r:
+        assert [c.count for c in r.chunks] == [10, 20]
+
+
+def test_append_after_partial_chunk(tmp_path, dev):
+    path = str(tmp_path / 'a.rec')
+    _record(path, dev, 10)
+    # chunk cut short, e.g. the recorder was killed while writing it
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 50)
+    _record(path, dev, 20)
+
+    with Recording(path) as r:
+        assert [c.count for c in r.chunks] == [20]
+        model = r.model(r.chunks[0].model_id)
+        frames = [bytes(frame) for t, s, m, frame in r.frames()]
+    assert all(dev._decode_struct(model, frame) is not None for frame in frames)
+
+
+def test_scan_skips_damaged_chunk(tmp_path, dev):
+    path = str(tmp_path / 'a.rec')
+    with Recorder(path) as rec:
+        rec.attach(dev)
+        for i in range(10):
+            dev.histogram()
+        rec.flush()
+        for i in range(5):
+            dev.histogram()
+
+    with Recording(path) as r:
+        first = r.chunks[0]
+        first_end = first.offset + first.count * (8 + first.size)
+    data = open(path, 'rb').read()
+    # drop bytes in the middle of the first chunk
+    with open(path, 'wb') as f:
+        f.write(data[:first_end - 30] + data[first_end:])
+
+    with Recording(path) as r:
+        assert [c.count for c in r.chunks] == [5]
+
+
+def test_serial_kept_after_reset(tmp_path, dev):
+    path = str(tmp_path / 'a.rec')
+    with Recorder(path) as rec:
+        rec.attach(dev)
+        dev.histogram()
+        dev.reset()
+        assert 'serial' not in dev.capabilities
+        dev.histogram()
+    with Recording(path) as r:
+        assert [c.serial for c in r.chunks] == ['OPC-N3 123']
+        assert len(r) == 2
+
+
+def test_explicit_serial(tmp_path, dev):
+    path = str(tmp_path / 'a.rec')
+    with Recorder(path) as rec:
+        rec.attach(dev, serial='lab-7')
+        dev.histogram()
+    with Recording(path) as r:
+        assert [c.serial for c in r.chunks] == ['lab-7']
@@ -0,0 +1,113 @@
+"""Error recovery and circuit breaker"""
+import pytest
+
+import opcng
+from opcng import CircuitBreaker, RecoveryPolicy, WaitPolicy
+from opcng.emulator import SimulatedSPI
+
+CHECK_STATUS = 0xCF
+
+
+class Clock(object):
+    def __init__(self):
+        self.t = 0.
+
+    def __call__(self):
+        return self.t
+
+
+def test_breaker_opens_and_recovers():
+    clock = Clock()
+    b = CircuitBreaker(RecoveryPolicy(failure_threshold=3, open_interval=10.,
+                                      max_open_interval=25.), clock)
+    assert b.failure() is None
+    assert b.failure() is None
+    assert b.failure() == 'circuit_open'
+    assert not b.allow()
+
+    clock.t = 10.
+    assert b.allow() and b.state == 'half-open'
+    # failed trial, the interval doubles
+    assert b.failure() == 'circuit_open'
+    clock.t = 29.
+    assert not b.allow()
+    clock.t = 30.
+    assert b.allow()
+    assert b.failure() == 'circuit_open'
+    # capped to max_open_interval
+    assert b.until == 55.
+
+    clock.t = 55.
+    assert b.allow()
+    assert b.success()
+    assert b.state == 'closed' and b.failures == 0
+
+
+def test_breaker_quarantine():
+    clock = Clock()
+    b = CircuitBreaker(RecoveryPolicy(), clock)
+    assert b.failure(settle=5.) == 'quarantine'
+    assert not b.available()
+    clock.t = 5.
+    assert b.allow() and b.state == 'closed'
+
+
+def _device(spi, wait_policy, **kwargs):
+    return opcng.OPCN3(spi, wait_policy=wait_policy, metrics=opcng.Metrics(), **kwargs)
+
+
+def test_reset_quarantines_device():
+    spi = SimulatedSPI('N3', busy_polls=1000)
+    dev = _device(spi, WaitPolicy(initial=0.0001, reset_after=3, settle=60.))
+    assert dev.histogram() is None
+    assert dev.metrics.events['quarantine'] == 1
+    # skipped without touching the bus
+    polls = sum(spi.commands.values())
+    assert dev.histogram() is None
+    assert sum(spi.commands.values()) == polls
+    assert dev.metrics.events['skipped'] == 1
+
+
+def test_timeouts_are_retried():
+    spi = SimulatedSPI('N3', busy_polls=1000)
+    policy = WaitPolicy(initial=0.0001, reset_after=10000, deadline=0.005)
+    dev = _device(spi, policy, recovery=RecoveryPolicy(retries=2, retry_delay=0.))
+    assert dev.histogram() is None
+    assert dev.metrics.events['retry'] == 2
+    assert dev.breaker.failures == 1
+
+
+def test_circuit_opens_after_repeated_failures():
+    spi = SimulatedSPI('N3', busy_polls=1000)
+    policy = WaitPolicy(initial=0.0001, reset_after=10000, deadline=0.002)
+    dev = _device(spi, policy, recovery=RecoveryPolicy(failure_threshold=2, open_interval=60.))
+    dev.histogram()
+    dev.histogram()
+    assert dev.breaker.state == 'open'
+    assert dev.metrics.events['circuit_open'] == 1
+    assert not dev.ping()
+
+
+def test_passed_wait_policy():
+    spi = SimulatedSPI('N3', busy_polls=5)
+    dev = _device(spi, WaitPolicy(initial=0.0001, reset_after=2))
+    dev._send_command_and_wait(CHECK_STATUS, WaitPolicy(initial=0.0001))
+    with pytest.raises(opcng._OPCError):
+        dev._send_command_and_wait(CHECK_STATUS)
+
+
+def test_ping_failure():
+    dev = _device(SimulatedSPI('N3', error_rate=1.), WaitPolicy(initial=0.0001))
+    assert not dev.ping()
+    assert dev.metrics.events['spi_error'] == 1
+    assert dev.breaker.failures == 1
+    assert not dev.breaker.available()
+
+
+def test_recovery():
+    spi = SimulatedSPI('N3', busy_polls=0, error_rate=1.)
+    dev = _device(spi, WaitPolicy(initial=0.0001, settle=0.))
+    assert dev.histogram() is None
+    spi.error_rate = 0.
+    assert dev.histogram() is not None
+    assert dev.metrics.events['recovery'] == 1
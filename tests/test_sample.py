@@ -0,0 +1,45 @@
+"""Histogram and PM values from a single read"""
+import asyncio
+import time
+
+import opcng
+from opcng.aio import AsyncOPCN3
+from opcng.emulator import SimulatedSPI
+from opcng.scheduler import Scheduler
+
+READ_HISTOGRAM = 0x30
+
+
+def _spi(**kwargs):
+    return SimulatedSPI('N3', busy_polls=0, seed=1, **kwargs)
+
+
+def test_sample():
+    spi = _spi()
+    dev = opcng.OPCN3(spi, wait_policy=opcng.FAST_WAIT_POLICY)
+    hist, pm = dev.sample()
+    assert spi.commands[READ_HISTOGRAM] == 1
+    assert pm == {f: hist[f] for f in ('PM1', 'PM2.5', 'PM10')}
+
+
+def test_sample_failure():
+    dev = opcng.OPCN3(_spi(corrupt_rate=1.), wait_policy=opcng.FAST_WAIT_POLICY)
+    assert dev.sample() is None
+
+
+def test_sample_failure_async():
+    dev = AsyncOPCN3(_spi(corrupt_rate=1.), wait_policy=opcng.FAST_WAIT_POLICY)
+    assert asyncio.run(dev.sample()) is None
+
+
+def test_scheduler_counts_failed_samples():
+    dev = opcng.OPCN3(_spi(corrupt_rate=1.), wait_policy=opcng.FAST_WAIT_POLICY)
+    received = []
+    s = Scheduler()
+    stats = s.add(dev, 0.01, lambda dev, sample, timestamp: received.append(sample),
+                  method='sample')
+    s.start()
+    time.sleep(0.1)
+    s.stop()
+    assert stats.errors > 0
+    assert stats.samples == 0 and not received
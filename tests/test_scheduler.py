@@ -0,0 +1,77 @@
+"""Multi-device polling scheduler"""
+import logging
+import threading
+import time
+
+import opcng
+from opcng.emulator import SimulatedSPI
+from opcng.scheduler import Scheduler
+
+
+def _device(**kwargs):
+    spi = SimulatedSPI('N3', busy_polls=0, seed=1, **kwargs)
+    return opcng.OPCN3(spi, wait_policy=opcng.FAST_WAIT_POLICY)
+
+
+def test_poll_devices():
+    devs = [_device() for i in range(3)]
+    received = {dev: 0 for dev in devs}
+    lock = threading.Lock()
+
+    def callback(dev, sample, timestamp):
+        with lock:
+            received[dev] += 1
+
+    s = Scheduler()
+    for dev in devs:
+        s.add(dev, 0.01, callback)
+    s.run(0.15)
+    for dev, stats in s.stats.items():
+        assert stats.samples > 0 and stats.errors == 0
+        assert received[dev] == stats.samples
+    assert not any(t.is_alive() for t in threading.enumerate() if t.name.startswith('opcng-bus'))
+
+
+def test_callback_errors(caplog):
+    def callback(dev, sample, timestamp):
+        raise RuntimeError('boom')
+
+    s = Scheduler()
+    stats = s.add(_device(), 0.01, callback)
+    with caplog.at_level(logging.CRITICAL):
+        s.run(0.1)
+    assert stats.samples > 1
+    assert stats.callback_errors == stats.samples
+
+
+def test_start_idempotent():
+    s = Scheduler()
+    s.add(_device(), 0.01, lambda *args: None)
+    s.start()
+    s.start()
+    try:
+        assert len(s._threads) == 1
+    finally:
+        s.stop()
+    assert s._threads == []
+
+
+def test_poll_errors():
+    s = Scheduler()
+    stats = s.add(_device(corrupt_rate=1.), 0.01, lambda *args: None)
+    s.run(0.1)
+    assert stats.samples == 0
+    assert stats.errors + stats.skipped > 0
+
+
+def test_missed_deadlines():
+    t = [0.]
+    s = Scheduler(clock=lambda: t[0])
+    stats = s.add(_device(), 1., lambda *args: None)
+    task = s._buses[next(iter(s._buses))][0]
+    task.start, task.count = 0., 0
+    t[0] = 3.5
+    s._poll(task)
+    assert stats.missed == 3
+    assert stats.lag == 0.5
+    assert task.deadline() == 4.
@@ -0,0 +1,67 @@
+"""Shared memory publish/subscribe"""
+import math
+import os
+
+import pytest
+
+import opcng
+from opcng.emulator import SimulatedSPI
+from opcng.shm import Publisher, Subscriber
+
+
+@pytest.fixture
+def dev():
+    spi = SimulatedSPI('N3', busy_polls=0, seed=1)
+    return opcng.OPCN3(spi, wait_policy=opcng.FAST_WAIT_POLICY)
+
+
+@pytest.fixture
+def name():
+    return 'opcng-test-{}'.format(os.getpid())
+
+
+def test_publish_subscribe(dev, name):
+    with Publisher(name, dev._histogram_model, capacity=4) as pub:
+        with Subscriber(name) as sub:
+            assert sub.model is dev._histogram_model
+            assert sub.latest() is None
+            hists = [dev.histogram() for i in range(3)]
+            for i, hist in enumerate(hists):
+                assert pub.publish(float(i), hist) == i
+            samples = sub.poll()
+            assert [n for n, t, s in samples] == [0, 1, 2]
+            assert samples[1][2]['PM2.5'] == pytest.approx(hists[1]['PM2.5'])
+            assert sub.latest()[0] == 2.
+            assert sub.poll() == []
+
+
+def test_lost_samples(dev, name):
+    with Publisher(name, dev._histogram_model, capacity=4) as pub:
+        with Subscriber(name) as sub:
+            hist = dev.histogram()
+            for i in range(10):
+                pub.publish(float(i), hist)
+            samples = sub.poll()
+            assert [n for n, t, s in samples] == [6, 7, 8, 9]
+            assert sub.lost == 6
+            assert sub.read(0) is None
+
+
+def test_partial_sample(dev, name):
+    with Publisher(name, dev._histogram_model, capacity=4) as pub:
+        with Subscriber(name) as sub:
+            pub.publish(1., dev.histogram(fields=['PM1']))
+            t, sample = sub.latest()
+            assert not math.isnan(sample['PM1'])
+            assert math.isnan(sample['PM10'])
+
+
+def test_not_a_ring(name):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name, create=True, size=128)
+    try:
+        with pytest.raises(ValueError):
+            Subscriber(name)
+    finally:
+        shm.close()
+        shm.unlink()
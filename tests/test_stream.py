@@ -0,0 +1,44 @@
+"""Periodic histogram streaming"""
+import asyncio
+
+import pytest
+
+import opcng
+from opcng.aio import AsyncOPCN3
+from opcng.emulator import SimulatedSPI
+
+
+def _spi():
+    return SimulatedSPI('N3', busy_polls=0, seed=1)
+
+
+def test_stream():
+    dev = opcng.OPCN3(_spi(), wait_policy=opcng.FAST_WAIT_POLICY)
+    samples = list(dev.stream(period=0.001, count=5))
+    assert len(samples) == 5
+    assert all(hist is not None for t, hist in samples)
+
+
+@pytest.mark.parametrize('period', [0., -1.])
+def test_invalid_period(period):
+    dev = opcng.OPCN3(_spi())
+    with pytest.raises(ValueError):
+        dev.stream(period=period, raw=True, count=50)
+    with pytest.raises(ValueError):
+        dev.stream(period=period, buffer=10)
+
+
+@pytest.mark.parametrize('period', [0., -1.])
+def test_invalid_period_async(period):
+    dev = AsyncOPCN3(_spi())
+    with pytest.raises(ValueError):
+        dev.stream(period=period, raw=True, count=50)
+
+
+def test_stream_async():
+    dev = AsyncOPCN3(_spi(), wait_policy=opcng.FAST_WAIT_POLICY)
+
+    async def collect():
+        return [s async for s in dev.stream(period=0.001, raw=True, count=3)]
+    samples = asyncio.run(collect())
+    assert [len(raw) for t, raw in samples] == [dev._histogram_model.size] * 3
@@ -0,0 +1,71 @@
+"""Transactions on the emulator"""
+import logging
+
+import pytest
+
+import opcng
+from opcng.emulator import SimulatedSPI
+from opcng.record import Recorder, Recording
+
+READ_HISTOGRAM = 0x30
+
+
+def _device(cls=opcng.OPCN3, kind='N3', **kwargs):
+    spi = SimulatedSPI(kind, serial='{} 1'.format(kind), busy_polls=0, seed=1, **kwargs)
+    dev = cls(spi, wait_policy=opcng.FAST_WAIT_POLICY, metrics=opcng.Metrics())
+    return dev, spi
+
+
+@pytest.mark.parametrize('order', ['histogram first', 'pm first'])
+def test_shared_frame(tmp_path, order):
+    dev, spi = _device()
+    tx = dev.transaction()
+    if order == 'histogram first':
+        tx.histogram().pm(from_histogram=True)
+    else:
+        tx.pm(from_histogram=True).histogram()
+
+    path = str(tmp_path / 'a.rec')
+    with Recorder(path) as rec:
+        rec.attach(dev)
+        n = spi.commands.get(READ_HISTOGRAM, 0)
+        r = tx.run()
+        assert spi.commands.get(READ_HISTOGRAM, 0) - n == 1
+    assert r.error is None
+    assert r['pm'] == {f: r['histogram'][f] for f in ('PM1', 'PM2.5', 'PM10')}
+    with Recording(path) as rec:
+        assert len(rec) == 1
+
+
+def test_shared_frame_decoded_once(caplog):
+    dev, spi = _device(corrupt_rate=1.)
+    with caplog.at_level(logging.WARNING):
+        r = dev.transaction().histogram().pm(from_histogram=True).run()
+    assert r['histogram'] is None and r['pm'] is None
+    assert dev.metrics.events['checksum_failure'] == 1
+    assert caplog.text.count('invalid checksum') == 1
+
+
+def test_outputs_are_independent():
+    dev, spi = _device()
+    r = dev.transaction().histogram(raw=True).histogram(name='h2').pm(from_histogram=True).run()
+    raw, hist = r['histogram'], r['h2']
+    # raw and post processed copies of the same frame
+    assert raw['Bin 0'] == round(hist['Bin 0'] * hist['SFR'] * hist['Sampling Period'])
+    assert r['pm']['PM1'] == hist['PM1']
+
+
+def test_partial_histogram():
+    dev, spi = _device()
+    r = dev.transaction().histogram(fields=['PM1']).pm(from_histogram=True).run()
+    assert set(r['histogram']) == {'PM1'}
+    assert set(r['pm']) == {'PM1', 'PM2.5', 'PM10'}
+
+
+def test_failure_aborts_batch():
+    dev, spi = _device(unexpected_rate=1.)
+    r = dev.transaction().histogram().power_state().run()
+    assert not r.skipped and r.error is not None
+    assert r['histogram'] is None and r['power_state'] is None
+    r = dev.transaction().histogram().run()
+    assert r.skipped and r.error is not None